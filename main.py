@@ -1,11 +1,28 @@
-from src.memory_chat import process_question
-from src.doc_load import descargar_documentos
-from src.preprocessing import preprocess_pdf_directory
+import threading
+
+from src.memory_chat import aprocess_question, get_chain_with_history
+from src.preprocessing import get_retrieval_engine
+from src.metrics import start_metrics_server, METRICS_PORT
 import chainlit as cl
 
 # --- DESCARGA Y PREPROCESAMIENTO DE DOCUMENTOS ---
-descargar_documentos(urls_file="urls.txt", download_dir="docs")
-preprocess_pdf_directory(pdf_directory="docs")
+# Se hacen aparte, antes de arrancar el servidor:  python -m src.ingest --dir docs
+# El servidor solo usa el índice existente. El modelo de embeddings se precarga en segundo
+# plano para no retrasar el arranque y que la primera pregunta no espere.
+def warmup() -> None:
+    get_retrieval_engine().warmup()
+    # El chain (langchain_openai, ChatOpenAI y el almacén del historial) tampoco se construye
+    # en el event loop durante la primera pregunta
+    get_chain_with_history()
+
+
+threading.Thread(target=warmup, daemon=True).start()
+
+# --- MÉTRICAS ---
+# Con METRICS_PORT definido se sirven las latencias por etapa y los contadores en /metrics
+# (formato Prometheus); POST /profile perfila con cProfile la siguiente pregunta.
+if METRICS_PORT:
+    start_metrics_server(int(METRICS_PORT))
 
 # --- INICIALIZACIÓN DE LA CADENA DE PROCESAMIENTO ---
 @cl.on_chat_start
@@ -54,11 +71,11 @@ async def on_action_general(action: cl.Action):
 @cl.on_message
 async def main(message: str):
     module = cl.user_session.get("module")
-    prompt_module_text = f"Answer in the context of: {module}."
     session_id = cl.user_session.get("id")
-    # print(prompt_module_text)
-    if module:
-        response = process_question(message.content + prompt_module_text, session_id=session_id)
-    else:
-        response = process_question(message.content, session_id=session_id)
-    await cl.Message(content=response).send()
+    # El módulo se pasa aparte para que la detección de idioma use solo la pregunta original
+    question = message.content
+    # Envía los tokens al mensaje según van llegando del LLM
+    response = cl.Message(content="")
+    async for token in aprocess_question(question, session_id=session_id, module=module):
+        await response.stream_token(token)
+    await response.send()
@@ -0,0 +1,91 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+from src.metrics import metrics
+
+BATCH_MAX_SIZE = 32  # Peticiones máximas por lote
+BATCH_MAX_WAIT = 0.003  # Segundos que se espera a otras peticiones antes de procesar el lote
+
+
+class MicroBatcher:
+    """
+    Agrupa peticiones concurrentes en lotes para procesarlas con una sola llamada.
+
+    Un hilo en segundo plano toma la primera petición pendiente y espera como mucho
+    max_wait segundos (o hasta reunir max_batch_size) a que lleguen más. Las peticiones
+    del lote se agrupan por clave y cada grupo se procesa con fn(items, key), que debe
+    devolver un resultado por elemento; cada resultado se entrega por su Future.
+
+    Con un solo usuario, el coste añadido es como mucho max_wait por petición.
+
+    Args:
+        fn: Función (items, key) -> lista de resultados.
+        max_batch_size (int): Tamaño máximo de lote.
+        max_wait (float): Espera máxima en segundos para completar un lote.
+    """
+
+    def __init__(self, fn, max_batch_size: int = BATCH_MAX_SIZE, max_wait: float = BATCH_MAX_WAIT,
+                 name: str = "microbatch"):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self._thread.start()
+
+    def submit(self, item, key=None) -> Future:
+        self._ensure_thread()
+        future = Future()
+        self._queue.put((item, key, future))
+        return future
+
+    def __call__(self, item, key=None):
+        return self.submit(item, key).result()
+
+    def _collect(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            groups = {}
+            for item, key, future in self._collect():
+                groups.setdefault(key, []).append((item, future))
+            for key, entries in groups.items():
+                # Cualquier error se entrega a las peticiones del grupo: el hilo nunca muere
+                # y ningún Future queda sin resolver
+                try:
+                    self._process(key, entries)
+                except BaseException as e:
+                    for _, future in entries:
+                        if not future.done():
+                            future.set_exception(e)
+
+    def _process(self, key, entries: list) -> None:
+        # Tamaño medio de lote = items / lotes
+        metrics.inc("rag_batches_total", batcher=self.name)
+        metrics.inc("rag_batch_items_total", len(entries), batcher=self.name)
+        results = list(self.fn([item for item, _ in entries], key))
+        if len(results) != len(entries):
+            raise RuntimeError(f"{self.name}: se esperaban {len(entries)} resultados y se obtuvieron {len(results)}")
+        for (_, future), result in zip(entries, results):
+            future.set_result(result)
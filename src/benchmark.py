@@ -0,0 +1,466 @@
+"""
+Benchmark offline de la ingesta y de las consultas:
+
+    python -m src.benchmark --output benchmark_results/actual.json --compare benchmark_results/base.json
+
+Genera un corpus sintético de PDFs (o usa --pdf-dir) con una pregunta etiquetada por página
+y mide, sin red: páginas/s y fragmentos/s de cada etapa de la ingesta, latencias p50/p95/p99
+de las consultas (recuperación y pregunta completa con el LLM y el traductor sustituidos),
+recall@k y el pico de memoria (RSS). El resultado se guarda en JSON para comparar commits.
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import textwrap
+import subprocess
+
+import numpy as np
+
+from src.metrics import metrics
+
+RESULTS_DIRECTORY = "benchmark_results"
+BENCH_DOCS = 4  # PDFs del corpus sintético
+BENCH_PAGES = 30  # Páginas por PDF
+BENCH_QUESTIONS = 40  # Preguntas etiquetadas
+BENCH_REPEATS = 3  # Repeticiones de cada pregunta para las latencias
+RECALL_K = (1, 3, 5)
+
+_SUBJECTS = ["pendulum", "capacitor", "ideal gas", "electron beam", "standing wave", "spring system",
+             "bar magnet", "thin lens", "viscous fluid", "crystal lattice", "rotating disk", "heat engine"]
+_QUANTITIES = ["energy", "momentum", "frequency", "temperature", "pressure", "charge", "electric field",
+               "entropy", "amplitude", "velocity", "angular momentum", "magnetic flux"]
+_FILLER = [
+    "The {a} of the {s} depends on the {b} and on the boundary conditions of the problem.",
+    "In the limit of small {a}, the {s} behaves like a harmonic system with a well defined {b}.",
+    "Careful measurements of the {a} show that the {s} conserves {b} to a very good approximation.",
+    "The equation of motion for the {s} follows from the balance between the {a} and the {b}.",
+    "When the {a} increases slowly, the {b} of the {s} changes adiabatically and no work is lost.",
+    "A dimensional argument relates the {a} of the {s} to its {b} without solving the full equations.",
+    "Students often confuse the {a} with the {b}, although the {s} makes the difference very clear.",
+    "The textbook derivation treats the {s} as isolated, so the total {a} and {b} remain constant.",
+]
+_SYLLABLES = ["kor", "va", "ne", "zel", "mor", "tri", "quen", "dal", "ros", "ith", "bel", "xan", "pru", "lo", "fen"]
+
+
+# --- Corpus sintético ---
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path: str, pages: list, line_chars: int = 95) -> None:
+    """
+    Escribe un PDF mínimo (Helvetica, una página por texto) con texto extraíble por pypdf.
+    """
+    n_pages = len(pages)
+    page_ids = [4 + 2 * i for i in range(n_pages)]
+    objects = {
+        1: "<< /Type /Catalog /Pages 2 0 R >>",
+        2: f"<< /Type /Pages /Kids [{' '.join(f'{p} 0 R' for p in page_ids)}] /Count {n_pages} >>",
+        3: "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    }
+    for page_id, text in zip(page_ids, pages):
+        lines = " ".join(f"({_pdf_escape(line)}) Tj T*" for line in textwrap.wrap(text, line_chars))
+        stream = f"BT /F1 10 Tf 12 TL 50 760 Td {lines} ET"
+        objects[page_id] = (f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {page_id + 1} 0 R >>")
+        objects[page_id + 1] = f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream"
+
+    data = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number in range(1, len(objects) + 1):
+        offsets.append(len(data))
+        data += f"{number} 0 obj\n{objects[number]}\nendobj\n".encode("latin-1")
+    xref = len(data)
+    data += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    for offset in offsets:
+        data += f"{offset:010d} 00000 n \n".encode("latin-1")
+    data += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def generate_corpus(directory: str, n_docs: int = BENCH_DOCS, n_pages: int = BENCH_PAGES,
+                    n_questions: int = BENCH_QUESTIONS, seed: int = 0) -> list:
+    """
+    Genera n_docs PDFs de n_pages páginas. Cada página contiene frases de relleno y un
+    dato inventado (un coeficiente con nombre único) sobre el que se hace una pregunta.
+
+    Returns:
+        List[dict]: Preguntas etiquetadas {"question", "source", "page"} (página 1-indexada).
+    """
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    used_names, labeled = set(), []
+    for doc in range(n_docs):
+        pdf_file = f"bench_{doc:02d}.pdf"
+        pages = []
+        for page in range(n_pages):
+            sentences = [
+                rng.choice(_FILLER).format(s=rng.choice(_SUBJECTS), a=a, b=b)
+                for a, b in (rng.sample(_QUANTITIES, 2) for _ in range(rng.randint(10, 16)))
+            ]
+            name = ""
+            while not name or name in used_names:
+                name = "".join(rng.choice(_SYLLABLES) for _ in range(3)).capitalize()
+            used_names.add(name)
+            subject = rng.choice(_SUBJECTS)
+            value = round(rng.uniform(1, 100), 2)
+            sentences.insert(rng.randrange(len(sentences)),
+                             f"The {name} coefficient of the {subject} is {value} units, as established in this section.")
+            pages.append(" ".join(sentences))
+            labeled.append({"question": f"What is the {name} coefficient of the {subject}?",
+                            "source": pdf_file, "page": page + 1})
+        write_pdf(os.path.join(directory, pdf_file), pages)
+    return rng.sample(labeled, min(n_questions, len(labeled)))
+
+
+# --- Utilidades de medida ---
+
+def peak_rss_mb(children: bool = False):
+    """
+    Pico de memoria residente (MB) del proceso o, con children=True, de los procesos hijos
+    ya terminados. Es acumulado: el máximo desde que arrancó el proceso.
+
+    Returns:
+        float | None: None si la plataforma no permite medirlo (resource solo existe en
+        Unix; en Windows se usa psutil si está instalado, y solo para el propio proceso).
+    """
+    try:
+        import resource
+    except ImportError:
+        if children:
+            return None
+        try:
+            import psutil
+        except ImportError:
+            return None
+        peak = getattr(psutil.Process().memory_info(), "peak_wset", None)
+        return round(peak / (1024 * 1024), 1) if peak is not None else None
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return round(usage / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def latency_summary(seconds: list) -> dict:
+    values = np.asarray(seconds, dtype=np.float64) * 1000
+    if not len(values):
+        return {"n": 0}
+    return {
+        "n": int(len(values)),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+    }
+
+
+def _throughput(seconds: float, pages: int = None, chunks: int = None) -> dict:
+    seconds = max(seconds, 1e-9)
+    result = {"seconds": round(seconds, 4)}
+    if pages is not None:
+        result.update(pages=pages, pages_per_second=round(pages / seconds, 2))
+    if chunks is not None:
+        result.update(chunks=chunks, chunks_per_second=round(chunks / seconds, 2))
+    return result
+
+
+def _stage_breakdown() -> dict:
+    # Tiempo total y número de observaciones por etapa según src.metrics
+    return {
+        h["labels"]["stage"]: {"count": h["count"], "seconds": round(h["sum"], 4)}
+        for h in metrics.snapshot()["histograms"] if h["name"] == "rag_stage_seconds"
+    }
+
+
+_CITATION = re.compile(r"^\[(.+?), p\. (\d+)\]")
+
+
+def _cited_pages(context: list) -> list:
+    pages = []
+    for fragment in context:
+        match = _CITATION.match(fragment)
+        if match:
+            pages.append((match.group(1), int(match.group(2))))
+    return pages
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class StubChain:
+    """
+    Sustituto del chain con historial: no llama al LLM, pero guarda el historial igual que
+    RunnableWithMessageHistory para que el resto de process_question se ejecute entero.
+    """
+
+    def __init__(self):
+        from src.history import InMemoryHistoryStore
+        self.history_store = InMemoryHistoryStore()
+
+    def get_session_history(self, session_id: str):
+        return self.history_store(session_id)
+
+    def invoke(self, inputs: dict, config: dict) -> str:
+        answer = f"{len(inputs['context'])} fragmentos de contexto."
+        history = self.get_session_history(config["configurable"]["session_id"])
+        history.add_user_message(inputs["question"])
+        history.add_ai_message(answer)
+        return answer
+
+
+# --- Etapas ---
+
+def bench_ingestion_stages(pdf_dir: str, chunk_size: int, text_cache_directory: str) -> dict:
+    """
+    Mide por separado cada etapa de la ingesta sobre los mismos PDFs (solo se escribe la
+    caché de texto extraído, en text_cache_directory).
+    """
+    from langchain_community.document_loaders import PyPDFLoader
+    from src.manifest import file_sha256
+    from src.text_cache import PageTextCache
+    from src.preprocessing import (get_nlp, get_retrieval_engine, spacy_chunk_text,
+                                   is_low_semantic_content, nlp_split_documents)
+
+    pdf_paths = sorted(os.path.join(pdf_dir, f) for f in os.listdir(pdf_dir) if f.endswith(".pdf"))
+    get_nlp()  # La carga del modelo de spaCy no cuenta en las etapas
+    results = {}
+
+    start = time.perf_counter()
+    documents = [page for path in pdf_paths for page in PyPDFLoader(path).lazy_load()]
+    results["pdf_load"] = _throughput(time.perf_counter() - start, pages=len(documents))
+
+    # Lectura desde la caché de texto (lo que se paga al re-indexar un PDF ya parseado)
+    text_cache = PageTextCache(text_cache_directory)
+    hashes = [file_sha256(path) for path in pdf_paths]
+    for path, content_hash in zip(pdf_paths, hashes):
+        for _ in text_cache.iter_pages(path, content_hash):
+            pass
+    start = time.perf_counter()
+    n_cached = sum(1 for path, content_hash in zip(pdf_paths, hashes)
+                   for _ in text_cache.iter_pages(path, content_hash))
+    results["text_cache_read"] = _throughput(time.perf_counter() - start, pages=n_cached)
+
+    start = time.perf_counter()
+    raw_chunks = [chunk for doc in documents for chunk in spacy_chunk_text(doc.page_content, chunk_size)]
+    results["spacy_chunk_text"] = _throughput(time.perf_counter() - start, pages=len(documents), chunks=len(raw_chunks))
+
+    start = time.perf_counter()
+    kept = sum(not is_low_semantic_content(chunk) for chunk in raw_chunks)
+    results["is_low_semantic_content"] = _throughput(time.perf_counter() - start, chunks=len(raw_chunks))
+    results["is_low_semantic_content"]["kept"] = kept
+
+    start = time.perf_counter()
+    fragments = nlp_split_documents(documents, chunk_size=chunk_size)
+    results["nlp_split_documents"] = _throughput(time.perf_counter() - start, pages=len(documents), chunks=len(fragments))
+
+    engine = get_retrieval_engine()
+    texts = [frag.page_content.replace("\n", " ") for frag in fragments]
+    engine.encode_documents(texts[:8], show_progress_bar=False)  # Carga del modelo fuera de la medida
+    start = time.perf_counter()
+    engine.encode_documents(texts, show_progress_bar=False)
+    results["embedding"] = _throughput(time.perf_counter() - start, chunks=len(texts))
+    results["embedding"]["device"] = engine.device
+    return results
+
+
+def bench_ingest(pdf_dir: str, workers: int, chunk_size: int, batch_size: int, n_pages: int,
+                 text_cache_directory: str) -> dict:
+    """
+    Ingesta completa (preprocess_pdf_directory) sobre un almacén vacío. El texto extraído
+    no se reutiliza: se parte de una caché de texto vacía.
+    """
+    from src.preprocessing import preprocess_pdf_directory, get_retrieval_engine
+
+    metrics.reset()
+    start = time.perf_counter()
+    preprocess_pdf_directory(pdf_dir, workers=workers, chunk_size=chunk_size, batch_size=batch_size,
+                             text_cache_directory=text_cache_directory)
+    result = _throughput(time.perf_counter() - start, pages=n_pages, chunks=get_retrieval_engine().collection.count())
+    result["workers"] = workers
+    result["peak_rss_children_mb"] = peak_rss_mb(children=True)
+    result["stages"] = _stage_breakdown()
+    return result
+
+
+def bench_queries(questions: list, repeats: int, recall_k: tuple) -> dict:
+    """
+    Latencia de query_vector_database (sin caché de embeddings) y de process_question con
+    el LLM y el traductor sustituidos, y recall@k de las preguntas etiquetadas.
+    """
+    import src.memory_chat as memory_chat
+    from src.translation import TranslationStage, IdentityBackend
+    from src.preprocessing import query_vector_database, get_retrieval_engine
+
+    engine = get_retrieval_engine()
+    query_vector_database(questions[0]["question"])  # Calentamiento (carga del índice léxico y del almacén)
+
+    metrics.reset()
+    retrieval_latencies, hits = [], {k: 0 for k in recall_k}
+    for repeat in range(repeats):
+        for item in questions:
+            engine.clear_cache()
+            start = time.perf_counter()
+            context = query_vector_database(item["question"])
+            retrieval_latencies.append(time.perf_counter() - start)
+            if repeat == 0:
+                cited = _cited_pages(context)
+                for k in recall_k:
+                    hits[k] += (item["source"], item["page"]) in cited[:k]
+    retrieval_stages = _stage_breakdown()
+
+    memory_chat.translation_stage = TranslationStage(backend=IdentityBackend())
+    memory_chat._chain_with_history = StubChain()
+    end_to_end_latencies = []
+    for repeat in range(repeats):
+        for i, item in enumerate(questions):
+            engine.clear_cache()
+            memory_chat.translation_stage.clear_cache()
+            start = time.perf_counter()
+            memory_chat.process_question(item["question"], session_id=f"bench-{repeat}-{i}", use_cache=False)
+            end_to_end_latencies.append(time.perf_counter() - start)
+
+    return {
+        "questions": len(questions),
+        "repeats": repeats,
+        "retrieval": latency_summary(retrieval_latencies),
+        "end_to_end": latency_summary(end_to_end_latencies),
+        "recall": {f"recall@{k}": round(hits[k] / len(questions), 4) for k in recall_k},
+        "retrieval_stages": retrieval_stages,
+    }
+
+
+# --- Comparación ---
+
+def _flatten(data: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare_results(previous: dict, current: dict) -> None:
+    """
+    Imprime las métricas de rendimiento comunes a dos resultados y su variación.
+    """
+    keys = ("per_second", "_ms", "recall@", "peak_rss")
+    old, new = _flatten(previous["results"]), _flatten(current["results"])
+    print(f"\nComparación {previous.get('commit')} -> {current.get('commit')}:")
+    for name in sorted(set(old) & set(new)):
+        if not any(key in name for key in keys):
+            continue
+        change = (new[name] - old[name]) / old[name] * 100 if old[name] else float("inf")
+        print(f"  {name}: {old[name]} -> {new[name]} ({change:+.1f}%)")
+
+
+# --- CLI ---
+
+def parse_args(argv=None):
+    from src.preprocessing import CHUNK_SIZE, INGEST_BATCH_SIZE, VECTOR_BACKEND
+
+    parser = argparse.ArgumentParser(description="Benchmark offline de la ingesta y las consultas.")
+    parser.add_argument("--output", help=f"Archivo JSON de resultados (por defecto, en {RESULTS_DIRECTORY}/).")
+    parser.add_argument("--compare", help="Resultado anterior (JSON) con el que comparar.")
+    parser.add_argument("--pdf-dir", help="Usar estos PDFs en lugar del corpus sintético.")
+    parser.add_argument("--questions", help="JSON con preguntas etiquetadas [{question, source, page}] para --pdf-dir.")
+    parser.add_argument("--docs", type=int, default=BENCH_DOCS, help="PDFs sintéticos.")
+    parser.add_argument("--pages", type=int, default=BENCH_PAGES, help="Páginas por PDF sintético.")
+    parser.add_argument("--n-questions", type=int, default=BENCH_QUESTIONS, help="Preguntas etiquetadas.")
+    parser.add_argument("--repeats", type=int, default=BENCH_REPEATS, help="Repeticiones de cada pregunta.")
+    parser.add_argument("--k", type=int, nargs="+", default=list(RECALL_K), help="Valores de k para recall@k.")
+    parser.add_argument("--workers", type=int, default=1, help="Procesos de la ingesta completa.")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--backend", default=VECTOR_BACKEND, help="Almacén vectorial: chroma o numpy.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="No borrar el directorio de trabajo.")
+    parser.add_argument("--allow-download", action="store_true",
+                        help="Permitir descargar el modelo de embeddings si no está en la caché local.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> dict:
+    args = parse_args(argv)
+    if not args.allow_download:
+        # Todo en local: el modelo de embeddings debe estar ya en la caché de Hugging Face
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+        os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+    import src.preprocessing as preprocessing
+
+    workdir = tempfile.mkdtemp(prefix="rag-bench-")
+    try:
+        if args.pdf_dir:
+            pdf_dir = args.pdf_dir
+            questions = []
+            if args.questions:
+                with open(args.questions, "r", encoding="utf-8") as f:
+                    questions = json.load(f)
+        else:
+            pdf_dir = os.path.join(workdir, "docs")
+            questions = generate_corpus(pdf_dir, args.docs, args.pages, args.n_questions, args.seed)
+
+        # Motor aislado: el benchmark nunca toca los índices reales
+        preprocessing._engine = preprocessing.RetrievalEngine(
+            persist_directory=os.path.join(workdir, "chroma_db"),
+            lexical_directory=os.path.join(workdir, "lexical_index"),
+            vector_backend=args.backend,
+            vector_directory=os.path.join(workdir, "vector_store"),
+        )
+
+        results = {"ingestion_stages": bench_ingestion_stages(pdf_dir, args.chunk_size,
+                                                              os.path.join(workdir, "text_cache_stages"))}
+        n_pages = results["ingestion_stages"]["pdf_load"]["pages"]
+        results["ingest"] = bench_ingest(pdf_dir, args.workers, args.chunk_size, args.batch_size, n_pages,
+                                         os.path.join(workdir, "text_cache"))
+        if questions:
+            results["queries"] = bench_queries(questions, args.repeats, tuple(args.k))
+        # Una sola vez: ru_maxrss es acumulado y no se puede atribuir a cada etapa
+        results["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        if args.keep:
+            print(f"Directorio de trabajo: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        RESULTS_DIRECTORY, f"bench-{report['commit'] or 'nogit'}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Resultados guardados en {output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare_results(json.load(f), report)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import os
+import re
+
+import numpy as np
+
+CONTEXT_MAX_TOKENS = 2500  # Presupuesto de tokens del contexto enviado al LLM
+CONTEXT_MAX_FRAGMENTS = 15  # Número máximo de fragmentos en el contexto
+CONTEXT_MAX_DISTANCE = 1.4  # Distancia L2² máxima (embeddings normalizados: coseno >= 0.3)
+MMR_LAMBDA = 0.7  # Peso de la relevancia frente a la diversidad en MMR
+DEDUP_THRESHOLD = 0.95  # Similitud coseno a partir de la cual dos fragmentos se consideran duplicados
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 caracteres por token: suficiente para respetar el presupuesto sin tokenizador
+    return len(text) // 4 + 1
+
+
+def format_citation(meta: dict) -> str:
+    """
+    Cita compacta del fragmento: nombre del archivo y página (1-indexada).
+    """
+    source = os.path.basename(str(meta.get("source", "?")))
+    page = meta.get("page", "N/A")
+    if isinstance(page, int):
+        page += 1
+    return f"[{source}, p. {page}]"
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def pack_context(documents: list, metadatas: list, distances: list, embeddings, query_embedding,
+                 max_tokens: int = CONTEXT_MAX_TOKENS, max_fragments: int = CONTEXT_MAX_FRAGMENTS,
+                 max_distance: float = CONTEXT_MAX_DISTANCE, mmr_lambda: float = MMR_LAMBDA,
+                 dedup_threshold: float = DEDUP_THRESHOLD, scores: list = None, exempt: list = None) -> list:
+    """
+    Selecciona y formatea los fragmentos del contexto:
+      - Descarta los candidatos con distancia mayor que max_distance (salvo los de exempt).
+      - Descarta duplicados exactos y casi duplicados (coseno >= dedup_threshold).
+      - Ordena por relevancia marginal máxima (MMR) para diversificar el contexto.
+      - Añade fragmentos hasta agotar max_tokens o max_fragments.
+
+    Args:
+        documents, metadatas, distances, embeddings: Resultados de collection.query para una consulta.
+        query_embedding: Embedding de la consulta.
+        scores (List[float]): Relevancia de cada candidato (p. ej. de una fusión de rankings).
+            Si no se indica, la relevancia es la similitud coseno con la consulta.
+        exempt (List[bool]): Candidatos a los que no se aplica el corte por distancia
+            (p. ej. los que encuentra la búsqueda léxica aunque su embedding quede lejos).
+
+    Returns:
+        List[str]: Fragmentos con su cita compacta, listos para el prompt.
+    """
+    candidates = [i for i, distance in enumerate(distances)
+                  if distance <= max_distance or (exempt is not None and exempt[i])]
+    if not candidates:
+        return []
+
+    vectors = _normalize_rows(np.asarray([embeddings[i] for i in candidates], dtype=np.float32))
+    # Sin división in situ: asarray no copia si el embedding ya es float32
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query = query / (np.linalg.norm(query) or 1)
+    if scores is None:
+        relevance = vectors @ query
+    else:
+        relevance = np.asarray([scores[i] for i in candidates], dtype=np.float32)
+        relevance /= relevance.max() or 1
+    similarity = vectors @ vectors.T
+
+    seen_texts, used_tokens = set(), 0
+    max_similarity = np.full(len(candidates), -np.inf, dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+    results = []
+    while available.any() and len(results) < max_fragments:
+        diversity = np.where(np.isfinite(max_similarity), max_similarity, 0)
+        mmr_scores = mmr_lambda * relevance - (1 - mmr_lambda) * diversity
+        mmr_scores[~available] = -np.inf
+        best = int(np.argmax(mmr_scores))
+        available[best] = False
+
+        # Casi duplicado de un fragmento ya elegido
+        if max_similarity[best] >= dedup_threshold:
+            continue
+        doc = documents[candidates[best]]
+        text_key = re.sub(r"\s+", " ", doc).strip().lower()
+        if text_key in seen_texts:
+            continue
+
+        entry = f"{format_citation(metadatas[candidates[best]])} {doc}"
+        cost = estimate_tokens(entry)
+        if used_tokens + cost > max_tokens:
+            # No cabe: probar con fragmentos más cortos
+            continue
+
+        used_tokens += cost
+        seen_texts.add(text_key)
+        results.append(entry)
+        max_similarity = np.maximum(max_similarity, similarity[best])
+    return results
@@ -1,60 +1,181 @@
 import os
-import requests
+import json
+import threading
 import urllib.parse
+from email.utils import formatdate
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DOWNLOAD_WORKERS = 4  # Descargas simultáneas
+CHUNK_BYTES = 1 << 16  # Tamaño de bloque al escribir en disco
+TIMEOUT = (10, 60)  # (conexión, lectura) en segundos
+META_FILENAME = ".download_meta.json"  # ETag/Last-Modified de cada URL descargada
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
+}
+
+
+def crear_sesion(max_workers: int = DOWNLOAD_WORKERS) -> requests.Session:
+    """
+    Crea una sesión HTTP con un pool de conexiones compartido por todas las descargas.
+    """
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class _DownloadMeta:
+    """
+    Metadatos de descarga (ETag, Last-Modified y nombre de archivo) por URL,
+    guardados en un JSON dentro del directorio de descarga.
+    """
+
+    def __init__(self, download_dir: str):
+        self.path = os.path.join(download_dir, META_FILENAME)
+        self.lock = threading.Lock()
+        self.data = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+
+    def get(self, url: str) -> dict:
+        with self.lock:
+            return dict(self.data.get(url, {}))
+
+    def set(self, url: str, value: dict) -> None:
+        with self.lock:
+            self.data[url] = value
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.data, f, indent=1)
+            os.replace(tmp_path, self.path)
+
+
+def _nombre_desde_url(url: str) -> str:
+    return urllib.parse.unquote(url.split("/")[-1])
+
+
+def _nombre_desde_respuesta(response, default: str) -> str:
+    # Obtener el nombre del archivo desde Content-Disposition o desde la URL
+    content_disposition = response.headers.get("Content-Disposition")
+    if content_disposition and "filename=" in content_disposition:
+        return os.path.basename(content_disposition.split("filename=")[-1].strip('\"; '))
+    return default
+
 
-def descargar_documentos(urls_file="urls.txt", download_dir="docs"):
+def descargar_url(session: requests.Session, url: str, download_dir: str, meta: _DownloadMeta) -> str:
+    """
+    Descarga una URL en streaming a un archivo temporal (.part) y lo renombra de forma
+    atómica al terminar, de modo que nunca queda un archivo final corrupto.
+
+    - Si el archivo ya existe, hace una petición condicional (If-None-Match /
+      If-Modified-Since) y lo omite si el servidor responde 304. Si el servidor no dio
+      ETag ni Last-Modified en la descarga anterior, no se puede revalidar y se omite.
+    - Si existe un .part de un intento anterior, reanuda con una cabecera Range.
+
+    Returns:
+        str: "descargado", "sin cambios", "reanudado" o "error".
+    """
+    previous = meta.get(url)
+    filename = previous.get("filename") or _nombre_desde_url(url)
+    file_path = os.path.join(download_dir, filename)
+    part_path = os.path.join(download_dir, _nombre_desde_url(url) + ".part")
+
+    headers = {}
+    if os.path.exists(file_path):
+        if "filename" in previous and not previous.get("etag") and not previous.get("last_modified"):
+            # Descargado de un servidor sin validadores: se conserva, como antes de revalidar
+            print(f"El archivo '{filename}' ya existe. Saltando...")
+            return "sin cambios"
+        if previous.get("etag"):
+            headers["If-None-Match"] = previous["etag"]
+        if previous.get("last_modified"):
+            headers["If-Modified-Since"] = previous["last_modified"]
+        elif not previous:
+            # Archivo descargado antes de guardar metadatos: usar su fecha de modificación
+            headers["If-Modified-Since"] = formatdate(os.path.getmtime(file_path), usegmt=True)
+
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        # Solo reanudar si el recurso no ha cambiado desde el intento anterior
+        validator = previous.get("partial_etag") or previous.get("partial_last_modified")
+        if validator:
+            headers["If-Range"] = validator
+
+    try:
+        with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+            if response.status_code == 304:
+                print(f"'{filename}' no ha cambiado. Saltando...")
+                return "sin cambios"
+            if response.status_code == 416:
+                # Rango no satisfacible: el .part no corresponde al recurso actual
+                os.remove(part_path)
+                print(f"Descarga parcial de '{filename}' no válida. Se reintentará desde cero.")
+                return "error"
+            if response.status_code not in (200, 206):
+                print(f"Error al descargar '{url}': {response.status_code}")
+                return "error"
+
+            resumed = response.status_code == 206
+            filename = _nombre_desde_respuesta(response, filename)
+            file_path = os.path.join(download_dir, filename)
+            validators = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            # Guardar los validadores del intento en curso para poder reanudarlo con If-Range
+            meta.set(url, {**previous, "partial_etag": validators["etag"],
+                           "partial_last_modified": validators["last_modified"]})
+
+            with open(part_path, "ab" if resumed else "wb") as f:
+                for block in response.iter_content(chunk_size=CHUNK_BYTES):
+                    f.write(block)
+
+        # Renombrado atómico: el archivo final solo aparece cuando está completo
+        os.replace(part_path, file_path)
+        meta.set(url, {"filename": filename, **validators})
+        print(f"Se ha descargado '{filename}'" + (" (reanudado)" if resumed else ""))
+        return "reanudado" if resumed else "descargado"
+
+    except (requests.exceptions.RequestException, OSError) as e:
+        print(f"Error de conexión al intentar descargar '{url}': {e}")
+        return "error"
+
+
+def descargar_documentos(urls_file="urls.txt", download_dir="docs", max_workers: int = DOWNLOAD_WORKERS,
+                         session: requests.Session = None) -> dict:
     """
     Descarga documentos desde las URLs listadas en un archivo de texto.
 
+    Las descargas se hacen en paralelo (hasta max_workers a la vez) sobre una sesión con
+    pool de conexiones compartido.
+
     Args:
         urls_file (str): Ruta del archivo que contiene las URLs (una por línea).
         download_dir (str): Directorio donde se guardarán los documentos.
+        max_workers (int): Número máximo de descargas simultáneas.
+        session (requests.Session): Sesión HTTP a reutilizar (por defecto se crea una).
+
+    Returns:
+        dict: Resultado de cada URL ("descargado", "sin cambios", "reanudado" o "error").
     """
-    
+
     # Verificar y crear el directorio de descarga si no existe
-    if not os.path.exists(download_dir):
-        os.mkdir(download_dir)
+    os.makedirs(download_dir, exist_ok=True)
 
     # Leer las URLs desde el archivo
     with open(urls_file, "r") as f:
-        urls = [line.strip() for line in f]
-
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
-    }
-
-    for url in urls:
-        filename = url.split("/")[-1]
-        filename = urllib.parse.unquote(filename)
-        file_path = os.path.join(download_dir, filename)
-        if os.path.exists(file_path):
-                print(f"'{filename}' ya existe. Saltando...")
-                continue 
-        try:
-            response = requests.get(url, headers=headers)
-            
-            # Excepción si la respuesta no es 200 (OK)
-            if response.status_code != 200:
-                print(f"Error al descargar '{url}': {response.status_code}")
-                continue
-            
-            # Obtener el nombre del archivo desde Content-Disposition o desde la URL
-            content_disposition = response.headers.get("Content-Disposition")
-            if content_disposition:
-                filename = content_disposition.split("filename=")[-1].strip('\"')
-            file_path = os.path.join(download_dir, filename)
-            
-            # Verificar si el archivo ya existe
-            if os.path.exists(file_path):
-                print(f"'{filename}' ya existe. Saltando...")
-                continue
-            
-            # Guardar el archivo
-            with open(file_path, "wb") as f:
-                f.write(response.content)
-            
-            print(f"Se ha descargado '{filename}'")
-        
-        except requests.exceptions.RequestException as e:
-            print(f"Error de conexión al intentar descargar '{url}': {e}")
+        urls = [line.strip() for line in f if line.strip()]
 
+    meta = _DownloadMeta(download_dir)
+    session = session or crear_sesion(max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        resultados = pool.map(lambda url: descargar_url(session, url, download_dir, meta), urls)
+        return dict(zip(urls, resultados))
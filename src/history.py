@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import HumanMessage, message_to_dict, messages_from_dict
+
+HISTORY_MAX_TOKENS = 2000  # Presupuesto de tokens del historial enviado al LLM por sesión
+HISTORY_MAX_SESSIONS = 1000  # Sesiones en memoria antes de expulsar la menos usada
+HISTORY_IDLE_TTL = 2 * 3600  # Segundos de inactividad tras los que se borra una sesión
+
+
+def count_tokens(message) -> int:
+    """
+    Estimación rápida de tokens de un mensaje (~4 caracteres por token más un pequeño
+    coste fijo por mensaje). Basta para acotar el historial sin cargar un tokenizador.
+    """
+    content = message.content if isinstance(message.content, str) else json.dumps(message.content)
+    return len(content) // 4 + 4
+
+
+def _truncate(message, max_tokens: int):
+    if not isinstance(message.content, str) or count_tokens(message) <= max_tokens:
+        return message
+    chars = max(max_tokens - 4, 1) * 4
+    return message.model_copy(update={"content": message.content[:chars - 1] + "…"})
+
+
+def trim_to_budget(messages: list, max_tokens: int = HISTORY_MAX_TOKENS) -> list:
+    """
+    Conserva los mensajes más recientes que caben en max_tokens, empezando siempre en un
+    mensaje del usuario para no dejar una respuesta sin su pregunta.
+
+    Si ni siquiera el último intercambio cabe (p. ej. una respuesta larga con LaTeX), se
+    conserva recortado en lugar de vaciar la sesión: los mensajes cortos se mantienen
+    enteros y el resto del presupuesto se reparte entre los largos.
+    """
+    total = 0
+    start = len(messages)
+    for i in range(len(messages) - 1, -1, -1):
+        total += count_tokens(messages[i])
+        if total > max_tokens:
+            break
+        start = i
+    while start < len(messages) and not isinstance(messages[start], HumanMessage):
+        start += 1
+    if start < len(messages):
+        return messages[start:]
+
+    last_question = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=None)
+    if last_question is None:
+        return []
+    exchange = messages[last_question:]
+    kept = list(exchange)
+    remaining = max_tokens
+    by_size = sorted(range(len(exchange)), key=lambda i: count_tokens(exchange[i]))
+    for n, i in enumerate(by_size):
+        kept[i] = _truncate(exchange[i], remaining // (len(exchange) - n))
+        remaining -= count_tokens(kept[i])
+    return kept
+
+
+class TokenWindowChatMessageHistory(BaseChatMessageHistory):
+    """
+    Historial en memoria que solo conserva la ventana de mensajes recientes que cabe en
+    el presupuesto de tokens.
+    """
+
+    def __init__(self, max_tokens: int = HISTORY_MAX_TOKENS):
+        self.max_tokens = max_tokens
+        self._messages = []
+
+    @property
+    def messages(self) -> list:
+        return list(self._messages)
+
+    def add_messages(self, messages) -> None:
+        self._messages = trim_to_budget(self._messages + list(messages), self.max_tokens)
+
+    def clear(self) -> None:
+        self._messages = []
+
+
+class InMemoryHistoryStore:
+    """
+    Almacén de historiales por sesión con expulsión LRU (max_sessions) y por inactividad
+    (idle_ttl). Se usa como get_session_history de RunnableWithMessageHistory.
+
+    Args:
+        max_sessions (int): Número máximo de sesiones en memoria.
+        idle_ttl (float): Segundos de inactividad tras los que se descarta una sesión.
+        max_tokens (int): Presupuesto de tokens del historial de cada sesión.
+    """
+
+    def __init__(self, max_sessions: int = HISTORY_MAX_SESSIONS, idle_ttl: float = HISTORY_IDLE_TTL,
+                 max_tokens: int = HISTORY_MAX_TOKENS):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_tokens = max_tokens
+        self._sessions = OrderedDict()  # session_id -> (historial, último acceso)
+        self._lock = threading.Lock()
+
+    def _evict(self, now: float) -> None:
+        # Las sesiones están ordenadas por último acceso: las inactivas están al principio
+        while self._sessions:
+            session_id, (_, last_access) = next(iter(self._sessions.items()))
+            if now - last_access <= self.idle_ttl and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[session_id]
+
+    def __call__(self, session_id: str) -> BaseChatMessageHistory:
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            history = entry[0] if entry else TokenWindowChatMessageHistory(self.max_tokens)
+            self._sessions[session_id] = (history, now)
+            self._evict(now)
+        return history
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+class SQLiteChatMessageHistory(BaseChatMessageHistory):
+    """
+    Historial de una sesión guardado en SQLite, compartible entre varios procesos.
+    Al añadir mensajes se borran los que quedan fuera del presupuesto de tokens y se
+    actualiza el último acceso de la sesión.
+    """
+
+    def __init__(self, store: "SQLiteHistoryStore", session_id: str):
+        self.store = store
+        self.session_id = session_id
+
+    def _rows(self, conn) -> list:
+        return conn.execute(
+            "SELECT id, message FROM messages WHERE session_id = ? ORDER BY id", (self.session_id,)
+        ).fetchall()
+
+    @property
+    def messages(self) -> list:
+        with self.store.connect() as conn:
+            rows = self._rows(conn)
+        return messages_from_dict([json.loads(message) for _, message in rows])
+
+    def add_messages(self, messages) -> None:
+        # langchain lo ejecuta en un executor (aadd_messages): aquí sí se puede escribir
+        self.store.touch(self.session_id)
+        with self.store.connect() as conn:
+            conn.executemany(
+                "INSERT INTO messages (session_id, message) VALUES (?, ?)",
+                [(self.session_id, json.dumps(message_to_dict(m))) for m in messages],
+            )
+            rows = self._rows(conn)
+            if not rows:
+                return
+            stored = messages_from_dict([json.loads(message) for _, message in rows])
+            kept = trim_to_budget(stored, self.store.max_tokens)
+            kept_rows = rows[len(rows) - len(kept):] if kept else []
+            cutoff = kept_rows[0][0] if kept_rows else rows[-1][0] + 1
+            conn.execute("DELETE FROM messages WHERE session_id = ? AND id < ?", (self.session_id, cutoff))
+            # Mensajes recortados para que quepa el último intercambio
+            conn.executemany(
+                "UPDATE messages SET message = ? WHERE id = ?",
+                [(json.dumps(message_to_dict(message)), row_id)
+                 for (row_id, _), message, original in zip(kept_rows, kept, stored[len(stored) - len(kept):])
+                 if message is not original],
+            )
+
+    def clear(self) -> None:
+        with self.store.connect() as conn:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (self.session_id,))
+
+
+class SQLiteHistoryStore:
+    """
+    Almacén de historiales en SQLite (modo WAL) para compartir sesiones entre varios
+    workers del servidor. Las sesiones inactivas más de idle_ttl segundos se borran.
+
+    Args:
+        db_path (str): Ruta del archivo SQLite.
+        idle_ttl (float): Segundos de inactividad tras los que se borra una sesión.
+        max_tokens (int): Presupuesto de tokens del historial de cada sesión.
+    """
+
+    def __init__(self, db_path: str, idle_ttl: float = HISTORY_IDLE_TTL, max_tokens: int = HISTORY_MAX_TOKENS,
+                 purge_interval: float = 60):
+        self.db_path = db_path
+        self.idle_ttl = idle_ttl
+        self.max_tokens = max_tokens
+        self.purge_interval = purge_interval
+        self._last_purge = 0.0
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, message TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, id)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_access ON sessions (last_access)")
+
+    def connect(self) -> "_ClosingConnection":
+        # Una conexión por operación: seguro entre hilos y procesos
+        return _ClosingConnection(sqlite3.connect(self.db_path, timeout=30))
+
+    def purge(self, now: float = None) -> None:
+        """
+        Borra las sesiones inactivas y sus mensajes.
+        """
+        cutoff = (now or time.time()) - self.idle_ttl
+        with self.connect() as conn:
+            conn.execute(
+                "DELETE FROM messages WHERE session_id IN (SELECT session_id FROM sessions WHERE last_access < ?)",
+                (cutoff,),
+            )
+            conn.execute("DELETE FROM sessions WHERE last_access < ?", (cutoff,))
+
+    def touch(self, session_id: str) -> None:
+        """
+        Marca la sesión como usada y, como mucho cada purge_interval segundos, borra las
+        sesiones inactivas.
+        """
+        now = time.time()
+        if now - self._last_purge > self.purge_interval:
+            self._last_purge = now
+            self.purge(now)
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT INTO sessions (session_id, last_access) VALUES (?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET last_access = excluded.last_access",
+                (session_id, now),
+            )
+
+    def __call__(self, session_id: str) -> BaseChatMessageHistory:
+        # Sin acceso a la base de datos: RunnableWithMessageHistory.astream lo llama de forma
+        # síncrona en el event loop. El último acceso se actualiza en add_messages.
+        return SQLiteChatMessageHistory(self, session_id)
+
+
+class _ClosingConnection:
+    """
+    Context manager que confirma (o revierte) la transacción y cierra la conexión.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            if exc_type is None:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            self.conn.close()
@@ -0,0 +1,53 @@
+"""
+Ingesta offline: descarga los PDFs de urls.txt y los indexa (ChromaDB/almacén NumPy e
+índice léxico). Se ejecuta aparte del servidor de chat:
+
+    python -m src.ingest --dir docs --workers 4
+"""
+import json
+import argparse
+
+from src.doc_load import descargar_documentos, DOWNLOAD_WORKERS
+from src.metrics import metrics
+from src.preprocessing import preprocess_pdf_directory, CHUNK_SIZE, INGEST_BATCH_SIZE, INGEST_WORKERS
+from src.text_cache import TEXT_CACHE_DIRECTORY
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Descarga e indexa los documentos PDF.")
+    parser.add_argument("--dir", default="docs", help="Directorio de los PDFs (por defecto: docs).")
+    parser.add_argument("--urls", default="urls.txt", help="Archivo con las URLs a descargar (por defecto: urls.txt).")
+    parser.add_argument("--no-download", action="store_true", help="No descargar; solo indexar el directorio.")
+    parser.add_argument("--download-workers", type=int, default=DOWNLOAD_WORKERS,
+                        help=f"Descargas simultáneas (por defecto: {DOWNLOAD_WORKERS}).")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help=f"Caracteres máximos por fragmento (por defecto: {CHUNK_SIZE}).")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE,
+                        help=f"Fragmentos por lote de embeddings (por defecto: {INGEST_BATCH_SIZE}).")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS,
+                        help=f"Procesos para parsear y fragmentar PDFs (por defecto: {INGEST_WORKERS}).")
+    parser.add_argument("--text-cache", default=TEXT_CACHE_DIRECTORY,
+                        help=f"Caché del texto extraído de los PDFs (por defecto: {TEXT_CACHE_DIRECTORY}).")
+    parser.add_argument("--metrics-out", help="Archivo JSON donde guardar las métricas de la ingesta.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    if not args.no_download:
+        descargar_documentos(urls_file=args.urls, download_dir=args.dir, max_workers=args.download_workers)
+    preprocess_pdf_directory(
+        pdf_directory=args.dir,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        batch_size=args.batch_size,
+        text_cache_directory=args.text_cache,
+    )
+    if args.metrics_out:
+        with open(args.metrics_out, "w", encoding="utf-8") as f:
+            json.dump(metrics.snapshot(), f, indent=2)
+        print(f"Métricas de la ingesta guardadas en {args.metrics_out}")
+
+
+if __name__ == "__main__":
+    main()
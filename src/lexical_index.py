@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from collections import Counter
+
+import numpy as np
+
+LEXICAL_DIRECTORY = "lexical_index"  # Junto a chroma_db
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60  # Constante de reciprocal rank fusion
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = RRF_K) -> list:
+    """
+    Combina varias listas de ids ordenadas por relevancia con reciprocal rank fusion.
+
+    Returns:
+        List[Tuple[str, float]]: Pares (id, puntuación) ordenados de mayor a menor.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class LexicalIndex:
+    """
+    Índice invertido BM25 en disco.
+
+    Durante la ingesta, las frecuencias de términos de cada fragmento se añaden por lotes
+    a un segmento por PDF (JSON lines en segments/). build() compacta todos los segmentos
+    en arrays de NumPy (offsets, ids de documento y frecuencias de cada posting), que se
+    cargan con memory-map; una consulta solo lee las listas de sus términos.
+
+    Cada compactación se escribe en un directorio nuevo y el archivo CURRENT apunta a la
+    versión activa, así que los lectores nunca ven un índice a medio escribir.
+
+    Args:
+        directory (str): Directorio del índice.
+    """
+
+    def __init__(self, directory: str = LEXICAL_DIRECTORY):
+        self.directory = directory
+        self.segments_dir = os.path.join(directory, "segments")
+        self._data = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    # --- Escritura (ingesta) ---
+
+    def _segment_path(self, source: str) -> str:
+        name = hashlib.sha1(source.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.segments_dir, f"{name}.jsonl")
+
+    def add_batch(self, source: str, ids: list, token_lists: list, modules: list) -> None:
+        """
+        Añade un lote de fragmentos (tokens ya normalizados) al segmento de su PDF.
+        """
+        os.makedirs(self.segments_dir, exist_ok=True)
+        with open(self._segment_path(source), "a", encoding="utf-8") as f:
+            for doc_id, tokens, module in zip(ids, token_lists, modules):
+                f.write(json.dumps({"id": doc_id, "module": module, "tf": Counter(tokens)}) + "\n")
+
+    def remove_source(self, source: str) -> None:
+        path = self._segment_path(source)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def has_source(self, source: str) -> bool:
+        return os.path.exists(self._segment_path(source))
+
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join(self.directory, "CURRENT"))
+
+    def build(self) -> None:
+        """
+        Compacta todos los segmentos en un índice nuevo y lo activa.
+        """
+        docs = {}
+        if os.path.isdir(self.segments_dir):
+            for name in sorted(os.listdir(self.segments_dir)):
+                with open(os.path.join(self.segments_dir, name), "r", encoding="utf-8") as f:
+                    for line in f:
+                        entry = json.loads(line)
+                        # Un lote repetido tras un fallo sobrescribe al anterior (mismo id)
+                        docs[entry["id"]] = entry
+
+        ids = list(docs)
+        modules = sorted({entry["module"] for entry in docs.values()})
+        module_ids = {module: i for i, module in enumerate(modules)}
+        postings = {}
+        doc_len = np.zeros(len(ids), dtype=np.uint32)
+        doc_module = np.zeros(len(ids), dtype=np.uint16)
+        for doc_index, doc_id in enumerate(ids):
+            entry = docs[doc_id]
+            doc_module[doc_index] = module_ids[entry["module"]]
+            for term, tf in entry["tf"].items():
+                postings.setdefault(term, []).append((doc_index, tf))
+                doc_len[doc_index] += tf
+
+        vocab = sorted(postings)
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        for i, term in enumerate(vocab):
+            offsets[i + 1] = offsets[i] + len(postings[term])
+        posting_docs = np.empty(offsets[-1], dtype=np.uint32)
+        posting_tf = np.empty(offsets[-1], dtype=np.uint16)
+        for i, term in enumerate(vocab):
+            pairs = np.asarray(postings[term], dtype=np.uint32)
+            posting_docs[offsets[i]:offsets[i + 1]] = pairs[:, 0]
+            posting_tf[offsets[i]:offsets[i + 1]] = np.minimum(pairs[:, 1], np.iinfo(np.uint16).max)
+
+        version = f"index-{time.time_ns()}"
+        target = os.path.join(self.directory, version)
+        os.makedirs(target)
+        np.save(os.path.join(target, "offsets.npy"), offsets)
+        np.save(os.path.join(target, "posting_docs.npy"), posting_docs)
+        np.save(os.path.join(target, "posting_tf.npy"), posting_tf)
+        np.save(os.path.join(target, "doc_len.npy"), doc_len)
+        np.save(os.path.join(target, "doc_module.npy"), doc_module)
+        with open(os.path.join(target, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"vocab": vocab, "ids": ids, "modules": modules}, f)
+
+        current = os.path.join(self.directory, "CURRENT")
+        previous = self._read_current()
+        with open(current + ".tmp", "w", encoding="utf-8") as f:
+            f.write(version)
+        os.replace(current + ".tmp", current)
+        if previous and previous != version:
+            shutil.rmtree(os.path.join(self.directory, previous), ignore_errors=True)
+        print(f"Índice léxico construido: {len(ids)} fragmentos, {len(vocab)} términos.")
+
+    # --- Lectura (consultas) ---
+
+    def _read_current(self):
+        try:
+            with open(os.path.join(self.directory, "CURRENT"), "r", encoding="utf-8") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _load(self):
+        """
+        Carga (o recarga si se ha compactado una versión nueva) el índice activo.
+        """
+        version = self._read_current()
+        if version is None:
+            return None
+        with self._lock:
+            if version != self._version:
+                try:
+                    self._data = self._read_version(version)
+                    self._version = version
+                except FileNotFoundError:
+                    # Otra compactación ha sustituido esta versión mientras se leía: se usa la anterior
+                    pass
+            return self._data
+
+    def _read_version(self, version: str) -> dict:
+        path = os.path.join(self.directory, version)
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        doc_len = np.load(os.path.join(path, "doc_len.npy"))
+        avg_len = float(doc_len.mean()) if len(doc_len) else 1.0
+        return {
+            "vocab": {term: i for i, term in enumerate(meta["vocab"])},
+            "ids": meta["ids"],
+            "modules": meta["modules"],
+            "offsets": np.load(os.path.join(path, "offsets.npy"), mmap_mode="r"),
+            "posting_docs": np.load(os.path.join(path, "posting_docs.npy"), mmap_mode="r"),
+            "posting_tf": np.load(os.path.join(path, "posting_tf.npy"), mmap_mode="r"),
+            "doc_module": np.load(os.path.join(path, "doc_module.npy"), mmap_mode="r"),
+            # Término de normalización por longitud de BM25, precalculado por documento
+            "length_norm": (BM25_K1 * (1 - BM25_B + BM25_B * doc_len / avg_len)).astype(np.float32),
+        }
+
+    def search(self, tokens: list, k: int = 30, module: str = None) -> list:
+        """
+        Busca con BM25 los fragmentos que mejor encajan con los tokens de la consulta.
+
+        Args:
+            tokens (List[str]): Tokens normalizados de la consulta.
+            k (int): Número de resultados.
+            module (str): Si se indica, solo se devuelven fragmentos de ese módulo.
+
+        Returns:
+            List[Tuple[str, float]]: Pares (id, puntuación) ordenados de mayor a menor.
+        """
+        data = self._load()
+        if not data or not data["ids"]:
+            return []
+        n_docs = len(data["ids"])
+        scores = np.zeros(n_docs, dtype=np.float32)
+        for term in set(tokens):
+            term_id = data["vocab"].get(term)
+            if term_id is None:
+                continue
+            start, end = data["offsets"][term_id], data["offsets"][term_id + 1]
+            docs = np.asarray(data["posting_docs"][start:end])
+            tf = np.asarray(data["posting_tf"][start:end], dtype=np.float32)
+            idf = np.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            scores[docs] += idf * tf * (BM25_K1 + 1) / (tf + data["length_norm"][docs])
+
+        if module is not None:
+            if module not in data["modules"]:
+                return []
+            scores[np.asarray(data["doc_module"]) != data["modules"].index(module)] = 0
+
+        k = min(k, int(np.count_nonzero(scores)))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(data["ids"][i], float(scores[i])) for i in top]
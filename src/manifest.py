@@ -0,0 +1,119 @@
+import os
+import json
+import hashlib
+
+MANIFEST_FILENAME = "ingest_manifest.json"
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    """
+    Calcula el hash SHA-256 del contenido de un archivo leyéndolo por bloques.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IngestManifest:
+    """
+    Manifiesto en disco con el estado de ingesta de cada PDF.
+
+    Cada entrada (indexada por la ruta normalizada del PDF) guarda el hash del contenido,
+    los parámetros de chunking, el modelo de embeddings, el número de fragmentos ya
+    escritos en ChromaDB y si la ingesta terminó. Con esto se decide sin consultar la
+    colección si un archivo se omite, se vuelve a indexar o se borra.
+
+    Args:
+        directory (str): Directorio donde se guarda el manifiesto (junto a ChromaDB).
+    """
+
+    def __init__(self, directory: str, filename: str = MANIFEST_FILENAME):
+        self.path = os.path.join(directory, filename)
+        self.entries = {}
+        self._hashes = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    def save(self) -> None:
+        # Escritura atómica: un fallo a mitad no deja el manifiesto corrupto
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def content_hash(self, source: str, file_path: str) -> str:
+        """
+        Devuelve el hash del archivo. Si el tamaño y la fecha de modificación coinciden con
+        los guardados, reutiliza el hash anterior sin volver a leer el archivo.
+        """
+        stat = os.stat(file_path)
+        entry = self.entries.get(source)
+        if entry and entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns:
+            return entry["sha256"]
+        key = (file_path, stat.st_size, stat.st_mtime_ns)
+        if key not in self._hashes:
+            self._hashes[key] = file_sha256(file_path)
+        return self._hashes[key]
+
+    def plan(self, source: str, file_path: str, params: dict) -> str:
+        """
+        Decide qué hacer con un archivo.
+
+        Returns:
+            str: "skip" si ya está indexado con el mismo contenido y parámetros,
+                 "resume" si la ingesta quedó a medias con el mismo contenido y parámetros,
+                 "reindex" si hay una entrada obsoleta,
+                 "new" si el archivo no aparece en el manifiesto.
+        """
+        entry = self.entries.get(source)
+        if entry is None:
+            return "new"
+        if entry.get("params") != params or entry.get("sha256") != self.content_hash(source, file_path):
+            return "reindex"
+        if entry.get("complete"):
+            return "skip"
+        return "resume"
+
+    def stale_ids(self, source: str) -> list:
+        """
+        Devuelve los ids de ChromaDB escritos para un archivo según el manifiesto.
+        """
+        entry = self.entries.get(source)
+        if not entry:
+            return []
+        return [f"{entry['name']}_doc_{i}" for i in range(entry.get("n_chunks", 0))]
+
+    def start(self, source: str, name: str, file_path: str, params: dict) -> None:
+        """
+        Registra el inicio de la ingesta de un archivo (entrada incompleta, 0 fragmentos).
+        """
+        stat = os.stat(file_path)
+        self.entries[source] = {
+            "name": name,
+            "sha256": self.content_hash(source, file_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "params": params,
+            "n_chunks": 0,
+            "complete": False,
+        }
+        self.save()
+
+    def commit_batch(self, source: str, n_chunks: int) -> None:
+        self.entries[source]["n_chunks"] = n_chunks
+        self.save()
+
+    def finish(self, source: str) -> None:
+        self.entries[source]["complete"] = True
+        self.save()
+
+    def remove(self, source: str) -> None:
+        self.entries.pop(source, None)
+        self.save()
+
+    def sources(self) -> list:
+        return list(self.entries)
@@ -1,19 +1,123 @@
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.chat_history import InMemoryChatMessageHistory
+import os
+import time
+import asyncio
+import hashlib
+import threading
+import itertools
+from functools import partial
+from collections import OrderedDict
 
-from deep_translator import GoogleTranslator
+import numpy as np
 
-from langdetect import detect
-from src.preprocessing import query_vector_database
+from src.translation import TranslationStage
+from src.history import InMemoryHistoryStore, SQLiteHistoryStore
+from src.context import estimate_tokens
+from src.metrics import metrics, request_profiler
+from src.preprocessing import query_vector_database, get_retrieval_engine
 
-def init_chain_components():
+# Configuración de la caché semántica de respuestas
+ANSWER_CACHE_THRESHOLD = 0.95  # Similitud coseno mínima para reutilizar una respuesta
+ANSWER_CACHE_SIZE = 512  # Número máximo de respuestas en caché
+ANSWER_CACHE_TTL = 6 * 3600  # Segundos que una respuesta se considera válida
+
+# Si se define, el historial de sesiones se guarda en SQLite y se comparte entre workers
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH")
+
+
+class SemanticAnswerCache:
+    """
+    Caché de respuestas indexada por el embedding de la pregunta y su ámbito (módulo
+    seleccionado e idioma de respuesta).
+
+    Una pregunta reutiliza una respuesta guardada si pertenece al mismo ámbito, su similitud
+    coseno supera el umbral y el contexto recuperado es idéntico al de la respuesta guardada.
+    Las entradas se expulsan por LRU (max_size) y por antigüedad (ttl).
+
+    Args:
+        threshold (float): Similitud coseno mínima para considerar un acierto.
+        max_size (int): Número máximo de entradas.
+        ttl (float): Segundos de validez de cada entrada.
+    """
+
+    def __init__(self, threshold: float = ANSWER_CACHE_THRESHOLD, max_size: int = ANSWER_CACHE_SIZE,
+                 ttl: float = ANSWER_CACHE_TTL):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # id -> (ámbito, vector normalizado, hash del contexto, respuesta, timestamp)
+        self.hits = 0
+        self.misses = 0
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def context_key(context: list) -> str:
+        return hashlib.sha1("\x1e".join(context).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _expire(self, now: float) -> None:
+        expired = [key for key, entry in self.entries.items() if now - entry[4] > self.ttl]
+        for key in expired:
+            del self.entries[key]
+
+    def lookup(self, embedding, scope: str, context: list):
+        """
+        Busca una respuesta para la pregunta. Devuelve None si no hay acierto.
+        """
+        vector = self._normalize(embedding)
+        context_hash = self.context_key(context)
+        with self._lock:
+            self._expire(time.time())
+            best_key, best_score = None, self.threshold
+            for key, (entry_scope, entry_vector, entry_context, _, _) in self.entries.items():
+                if entry_scope != scope or entry_context != context_hash:
+                    continue
+                score = float(np.dot(vector, entry_vector))
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(best_key)
+            return self.entries[best_key][3]
+
+    def store(self, embedding, scope: str, context: list, answer: str) -> None:
+        entry = (scope, self._normalize(embedding), self.context_key(context), answer, time.time())
+        with self._lock:
+            self.entries[next(self._ids)] = entry
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+def init_chain_components(history_store=None):
     """
     Inicializa el modelo, la plantilla del prompt y el objeto chain con historial.
     Devuelve el objeto chain_with_history.
+
+    Args:
+        history_store: Almacén de historiales por sesión (callable session_id -> historial).
+            Por defecto, SQLiteHistoryStore si HISTORY_DB_PATH está definido y si no
+            InMemoryHistoryStore; ambos acotan el historial a un presupuesto de tokens y
+            expulsan sesiones inactivas.
     """
+    from langchain_openai import ChatOpenAI
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+    from langchain_core.runnables.history import RunnableWithMessageHistory
+    from langchain_core.output_parsers import StrOutputParser
+
     # Inicializa el modelo de lenguaje
     model = ChatOpenAI(model="gpt-4o-mini-2024-07-18")
     
@@ -49,55 +153,216 @@ def init_chain_components():
     # Crea la cadena (chain) conectando el prompt, el modelo y el parser de salida
     chain = prompt_template | model | StrOutputParser()
     
-    # Diccionario para almacenar el historial por sesión
-    store = {}
-    
-    def get_by_session_id(session_id):
-        if session_id not in store:
-            store[session_id] = InMemoryChatMessageHistory()
-        return store[session_id]
+    # Almacén del historial por sesión (acotado en sesiones y en tokens)
+    if history_store is None:
+        history_store = SQLiteHistoryStore(HISTORY_DB_PATH) if HISTORY_DB_PATH else InMemoryHistoryStore()
     
     # Crea el objeto chain_with_history que gestiona el historial de mensajes
     chain_with_history = RunnableWithMessageHistory(
         chain,
-        get_by_session_id,
+        history_store,
         input_messages_key="question",
         history_messages_key="history",
     )
     
     return chain_with_history
 
-# Inicializamos el chain con historial una sola vez
-chain_with_history = init_chain_components()
+# El chain con historial se inicializa una sola vez, en el primer uso
+_chain_with_history = None
+_chain_lock = threading.Lock()
+
 
-def process_question(user_question: str, session_id: str = "foo") -> str:
+def get_chain_with_history():
     """
-    Procesa la pregunta del usuario:
-      - Detecta el idioma de la pregunta.
-      - Agrega un prompt que indique en qué idioma se debe responder.
-      - Consulta el contexto a través de query_vector_database.
-      - Invoca el chain con historial y retorna la respuesta.
-    """
-    # Detecta el idioma de la pregunta
-    language = detect(user_question)
-    # print(language)
-    if language == "es": 
-        # Traduce la pregunta al inglés para mejor búsqueda con embedding (así nos ahorramos tener que usar un modelo multilingüe)
-        user_question = GoogleTranslator(source=language, target="en").translate(user_question)
+    Devuelve el chain con historial, creándolo en el primer uso (importar este módulo
+    no carga langchain_openai ni crea el modelo).
+    """
+    global _chain_with_history
+    if _chain_with_history is None:
+        with _chain_lock:
+            if _chain_with_history is None:
+                _chain_with_history = init_chain_components()
+    return _chain_with_history
+
+# Etapa de detección de idioma y traducción (el backend se puede sustituir, p. ej. IdentityBackend)
+translation_stage = TranslationStage()
+
+# Caché semántica de respuestas compartida por todas las sesiones (None para desactivarla)
+answer_cache = SemanticAnswerCache()
+
+def prepare_question(user_question: str, module: str = None):
+    """
+    Prepara la pregunta del usuario (parte síncrona y costosa en CPU/red):
+      - Detecta el idioma de la pregunta original (sin el texto del módulo).
+      - Traduce al inglés si está en español (con caché y timeout).
+      - Agrega un prompt que indique en qué idioma se debe responder y el módulo.
+      - Consulta el contexto a través de query_vector_database, filtrando por el módulo.
+        Solo se hace el embedding de la pregunta traducida, sin las instrucciones del prompt.
+
+    Returns:
+        tuple: (final_question, context, search_query, language)
+    """
+    # Detecta el idioma y traduce al inglés para mejor búsqueda con embedding (así nos ahorramos tener que usar un modelo multilingüe)
+    language, user_question = translation_stage(user_question)
     language_prompt = f"Answer in {language}:"
-    final_question = f"{language_prompt} {user_question}. Remember the math formatting rules and to cite your sources."
+    module_prompt = f" Answer in the context of: {module}." if module else ""
+    final_question = f"{language_prompt} {user_question}.{module_prompt} Remember the math formatting rules and to cite your sources."
     
     # Consulta el contexto (por ejemplo, documentos relacionados)
-    context = query_vector_database(final_question)
+    with metrics.span("retrieval"):
+        context = query_vector_database(user_question, module=module)
     # print("-----------------")
     # print(context)
     # print("-----------------")
-    # Invoca el chain con historial
-    result = chain_with_history.invoke(
-        {"question": final_question, "context": context},
-        config={"configurable": {"session_id": session_id}},
-    )
-    return result
+    return final_question, context, user_question, language
+
+
+def _should_use_cache(session_id: str, use_cache) -> bool:
+    """
+    Por defecto (use_cache=None) la caché solo se usa en el primer turno de la sesión:
+    en preguntas de seguimiento el historial puede cambiar el sentido de la respuesta.
+    """
+    if answer_cache is None or use_cache is False:
+        return False
+    if use_cache is True:
+        return True
+    return not get_chain_with_history().get_session_history(session_id).messages
+
+
+def _lookup_cached_answer(search_query: str, context: list, scope: str):
+    """
+    Obtiene el embedding de la pregunta (el mismo que se usó en la búsqueda, ya en la
+    caché LRU del motor) y busca una respuesta guardada.
+
+    Returns:
+        tuple: (embedding, respuesta o None)
+    """
+    embedding = get_retrieval_engine().encode_query(search_query)
+    cached = answer_cache.lookup(embedding, scope, context)
+    metrics.inc("rag_cache_requests_total", cache="answer", result="miss" if cached is None else "hit")
+    return embedding, cached
+
+
+def _prepare_request(user_question: str, session_id: str, module: str = None, use_cache: bool = None):
+    """
+    Parte bloqueante de aprocess_question, que se ejecuta en un executor: preparación de la
+    pregunta, consulta del historial (puede ser SQLite) y de la caché de respuestas, y
+    registro en el historial de una respuesta cacheada. Solo se perfila esta parte
+    (cProfile mide un solo hilo).
+
+    Returns:
+        tuple: (final_question, context, language, cache_enabled, scope, embedding, respuesta cacheada o None)
+    """
+    with request_profiler.profile():
+        final_question, context, search_query, language = prepare_question(user_question, module)
+        cache_enabled = _should_use_cache(session_id, use_cache)
+        scope = f"{module}|{language}"
+        embedding = cached = None
+        if cache_enabled:
+            embedding, cached = _lookup_cached_answer(search_query, context, scope)
+            if cached is not None:
+                _record_cached_exchange(session_id, final_question, cached)
+        return final_question, context, language, cache_enabled, scope, embedding, cached
+
+
+def _record_request(session_id: str, module: str, language: str, final_question: str, context: list,
+                    answer: str, cached: bool, started: float) -> None:
+    metrics.inc("rag_requests_total", cached=cached)
+    metrics.inc("rag_tokens_total", estimate_tokens(final_question), kind="question")
+    metrics.inc("rag_tokens_total", estimate_tokens(answer), kind="answer")
+    metrics.log("request", session_id=session_id, module=module, language=language, fragments=len(context),
+                cached=cached, seconds=round(time.perf_counter() - started, 6))
+
+
+def _record_cached_exchange(session_id: str, final_question: str, answer: str) -> None:
+    # Mantiene el historial coherente aunque la respuesta no pase por el LLM
+    history = get_chain_with_history().get_session_history(session_id)
+    history.add_user_message(final_question)
+    history.add_ai_message(answer)
+
+
+def process_question(user_question: str, session_id: str = "foo", module: str = None, use_cache: bool = None) -> str:
+    """
+    Procesa la pregunta del usuario:
+      - Detecta el idioma y traduce si es necesario.
+      - Consulta el contexto a través de query_vector_database.
+      - Reutiliza una respuesta de la caché semántica si hay una equivalente.
+      - Si no, invoca el chain con historial y retorna la respuesta.
+
+    Args:
+        module (str): Módulo seleccionado (filtra la búsqueda, se añade al prompt y forma parte
+            de la clave de la caché).
+        use_cache (bool): True fuerza el uso de la caché, False la omite y None la usa solo
+            si la sesión no tiene historial.
+
+    Cada etapa se mide en src.metrics; con request_profiler.arm() la siguiente llamada se
+    perfila entera con cProfile.
+    """
+    started = time.perf_counter()
+    with request_profiler.profile(), metrics.span("request"):
+        with metrics.span("prepare"):
+            final_question, context, search_query, language = prepare_question(user_question, module)
+
+        cache_enabled = _should_use_cache(session_id, use_cache)
+        scope = f"{module}|{language}"
+        if cache_enabled:
+            embedding, cached = _lookup_cached_answer(search_query, context, scope)
+            if cached is not None:
+                _record_cached_exchange(session_id, final_question, cached)
+                _record_request(session_id, module, language, final_question, context, cached, True, started)
+                return cached
+
+        # Invoca el chain con historial
+        with metrics.span("llm"):
+            result = get_chain_with_history().invoke(
+                {"question": final_question, "context": context},
+                config={"configurable": {"session_id": session_id}},
+            )
+        if cache_enabled:
+            answer_cache.store(embedding, scope, context, result)
+        _record_request(session_id, module, language, final_question, context, result, False, started)
+        return result
+
+
+async def aprocess_question(user_question: str, session_id: str = "foo", module: str = None, use_cache: bool = None):
+    """
+    Versión asíncrona y en streaming de process_question.
+
+    La detección de idioma, la traducción, el embedding, la consulta a ChromaDB y los
+    accesos al historial y a la caché se ejecutan en un executor para no bloquear el event
+    loop; la respuesta del LLM se obtiene con astream y se devuelve token a token.
+
+    Yields:
+        str: Fragmentos de la respuesta según van llegando.
+    """
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    with metrics.span("request"):
+        with metrics.span("prepare"):
+            final_question, context, language, cache_enabled, scope, embedding, cached = await loop.run_in_executor(
+                None, partial(_prepare_request, user_question, session_id, module, use_cache)
+            )
+        if cached is not None:
+            _record_request(session_id, module, language, final_question, context, cached, True, started)
+            yield cached
+            return
+
+        tokens = []
+        with metrics.span("llm"):
+            llm_started = time.perf_counter()
+            async for token in get_chain_with_history().astream(
+                {"question": final_question, "context": context},
+                config={"configurable": {"session_id": session_id}},
+            ):
+                if not tokens:
+                    metrics.observe("rag_stage_seconds", time.perf_counter() - llm_started, stage="llm_first_token")
+                tokens.append(token)
+                yield token
+        answer = "".join(tokens)
+        if cache_enabled:
+            answer_cache.store(embedding, scope, context, answer)
+        _record_request(session_id, module, language, final_question, context, answer, False, started)
+
 
 if __name__ == "__main__":
     while True:
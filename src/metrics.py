@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import cProfile
+import pstats
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Si se define, main.py sirve las métricas en ese puerto (/metrics y /metrics.json)
+METRICS_PORT = os.getenv("METRICS_PORT")
+# Interfaz del servidor de métricas; solo local por defecto (POST /profile no tiene autenticación)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Si se define, cada span y cada evento se añaden a ese archivo como JSON lines
+METRICS_LOG_PATH = os.getenv("METRICS_LOG_PATH")
+PROFILE_DIRECTORY = os.getenv("PROFILE_DIRECTORY", "profiles")  # Perfiles de cProfile (.prof)
+# Límites (en segundos) de los buckets de los histogramas de latencia
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(items) -> str:
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in items) + "}"
+
+
+class Metrics:
+    """
+    Registro de métricas del pipeline en proceso: contadores e histogramas de latencia
+    con etiquetas.
+
+    span(stage) mide la duración de una etapa en el histograma rag_stage_seconds. Todo
+    se puede exportar en el formato de texto de Prometheus (render_prometheus) o como
+    diccionario (snapshot); si hay log_path, cada span y cada evento se escribe además
+    como una línea JSON.
+
+    Args:
+        log_path (str): Archivo JSON lines donde se registran spans y eventos (opcional).
+        buckets (tuple): Límites de los buckets de los histogramas.
+    """
+
+    def __init__(self, log_path: str = METRICS_LOG_PATH, buckets: tuple = LATENCY_BUCKETS):
+        self.log_path = log_path
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        """
+        Mide la duración del bloque como la etapa stage (aunque termine con una excepción).
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe("rag_stage_seconds", elapsed, stage=stage, **labels)
+            self.log("span", stage=stage, seconds=round(elapsed, 6), **labels)
+
+    def log(self, event: str, **fields) -> None:
+        if not self.log_path:
+            return
+        line = json.dumps({"ts": round(time.time(), 3), "event": event, **fields}, ensure_ascii=False, default=str)
+        with self._log_lock:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            histograms = [
+                {"name": name, "labels": dict(labels), "count": h["count"], "sum": h["sum"],
+                 "buckets": dict(zip(self.buckets, h["buckets"]))}
+                for (name, labels), h in sorted(self._histograms.items())
+            ]
+        return {"counters": counters, "histograms": histograms}
+
+    def render_prometheus(self) -> str:
+        """
+        Exporta las métricas en el formato de texto de Prometheus (versión 0.0.4).
+        """
+        snapshot = self.snapshot()
+        lines, typed = [], set()
+        for counter in snapshot["counters"]:
+            if counter["name"] not in typed:
+                lines.append(f"# TYPE {counter['name']} counter")
+                typed.add(counter["name"])
+            lines.append(f"{counter['name']}{_format_labels(sorted(counter['labels'].items()))} {counter['value']}")
+        for histogram in snapshot["histograms"]:
+            name, labels = histogram["name"], sorted(histogram["labels"].items())
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            for bound, count in histogram["buckets"].items():
+                lines.append(f"{name}_bucket{_format_labels(labels + [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels + [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+class RequestProfiler:
+    """
+    Perfila con cProfile una sola petición: tras arm() (o con PROFILE_NEXT_REQUEST=1 al
+    arrancar), la siguiente petición que pase por profile() se guarda como .prof en
+    directory y se imprimen las funciones con más tiempo acumulado.
+
+    cProfile solo mide el hilo desde el que se activa.
+
+    Args:
+        directory (str): Directorio de los perfiles.
+    """
+
+    def __init__(self, directory: str = PROFILE_DIRECTORY):
+        self.directory = directory
+        self._armed = os.getenv("PROFILE_NEXT_REQUEST") == "1"
+        self._lock = threading.Lock()
+
+    def arm(self) -> None:
+        with self._lock:
+            self._armed = True
+
+    @contextmanager
+    def profile(self, name: str = "request"):
+        with self._lock:
+            armed, self._armed = self._armed, False
+        if not armed:
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.prof")
+            profiler.dump_stats(path)
+            print(f"Perfil de la petición guardado en {path}")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+
+
+def start_metrics_server(port: int, host: str = METRICS_HOST, registry: Metrics = None,
+                         profiler: RequestProfiler = None) -> ThreadingHTTPServer:
+    """
+    Sirve las métricas en un hilo en segundo plano:
+      - GET /metrics: formato de texto de Prometheus.
+      - GET /metrics.json: el mismo contenido en JSON.
+      - POST /profile: perfila con cProfile la siguiente petición.
+    """
+    registry = registry or metrics
+    profiler = profiler or request_profiler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def _send(self, status: int, body: str, content_type: str = "text/plain; charset=utf-8") -> None:
+            data = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self._send(200, registry.render_prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+            elif self.path == "/metrics.json":
+                self._send(200, json.dumps(registry.snapshot()), "application/json")
+            else:
+                self._send(404, "not found\n")
+
+        def do_POST(self):
+            if self.path == "/profile":
+                profiler.arm()
+                self._send(202, "La siguiente petición se perfilará.\n")
+            else:
+                self._send(404, "not found\n")
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"Métricas disponibles en http://{host}:{port}/metrics")
+    return server
+
+
+# Registro y perfilador compartidos por todo el proceso
+metrics = Metrics()
+request_profiler = RequestProfiler()
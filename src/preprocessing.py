@@ -1,88 +1,365 @@
 import os
-import asyncio
-import torch
+import json
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from collections import OrderedDict
 from tqdm import tqdm
-import spacy
-from langchain_community.document_loaders import PyPDFLoader
-from sentence_transformers import SentenceTransformer
-import chromadb
-from langchain.docstore.document import Document  # Para crear nuevos documentos
+# torch, spaCy, sentence-transformers, ChromaDB y los loaders de langchain se importan
+# en el primer uso: importar este módulo no carga ningún modelo
+from src.manifest import IngestManifest, file_sha256
+from src.batching import MicroBatcher, BATCH_MAX_SIZE, BATCH_MAX_WAIT
+from src.context import pack_context, estimate_tokens, CONTEXT_MAX_TOKENS
+from src.metrics import metrics
+from src.lexical_index import LexicalIndex, LEXICAL_DIRECTORY, reciprocal_rank_fusion
+from src.vector_store import create_vector_store, NUMPY_STORE_DIRECTORY, NUMPY_STORE_DTYPE
+from src.text_cache import PageTextCache, TEXT_CACHE_DIRECTORY
 
 # Variables de configuración global
 PERSIST_DIRECTORY = "chroma_db"
 MODEL_NAME = "all-mpnet-base-v2"
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 COLLECTION_NAME = "pdf_fragments"
+# Almacén vectorial: "chroma" (ChromaDB) o "numpy" (matriz cuantizada con memory-map, ver src/vector_store.py)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
 CHUNK_SIZE = 1000  # Número máximo de caracteres por fragmento
+QUERY_CACHE_SIZE = 1024  # Número máximo de embeddings de consultas en caché
+QUERY_CANDIDATES = 30  # Candidatos recuperados antes de deduplicar y aplicar MMR
+GENERAL_MODULE = "General Physics"  # Módulo sin filtro (busca en toda la colección)
+# Área de física de cada fuente, sin distinguir mayúsculas: las claves terminadas en ".pdf" deben
+# coincidir con el nombre completo del archivo; el resto se buscan dentro del nombre
+SOURCE_MODULES = {
+    "Tipler_Llewellyn": "Quantum Physics",
+    "Introduction to Quantum Mechanics": "Quantum Physics",
+    "Introduction to Electrodynamics": "Electromagnetism",
+    "GoldsteinPooleSafkoClassicalMechanics": "Classical Mechanics",
+    "notes.pdf": "Thermodynamics",
+}
+INGEST_WORKERS = max(1, (os.cpu_count() or 1) - 1)  # Procesos para parsear y fragmentar PDFs
+INGEST_BATCH_SIZE = 256  # Fragmentos por lote enviado al consumidor de embeddings
+SPACY_MODEL = "en_core_web_sm"
+SPACY_BATCH_SIZE = 32  # Páginas por lote en nlp.pipe
+# Componentes de spaCy que no se usan para el chunking (solo necesitamos oraciones y flags léxicos).
+# En en_core_web_sm, el senter tiene su propia capa tok2vec: el tok2vec compartido solo lo usan
+# tagger y parser (se comprueba al cargar, ver load_spacy_model)
+SPACY_EXCLUDE = ["tok2vec", "tagger", "parser", "attribute_ruler", "lemmatizer", "ner"]
+
+def default_device() -> str:
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def load_spacy_model(model_name: str = SPACY_MODEL):
+    """
+    Carga spaCy solo con los componentes necesarios para separar oraciones.
 
-# Cargar el modelo de spaCy para el chunking (si no está instalado, se descarga)
-from spacy.cli import download
+    Se excluyen tok2vec, tagger, parser, lemmatizer y NER, y se activa el componente
+    "senter" (mucho más ligero que el parser). Si el senter de un modelo escucha al tok2vec
+    compartido en lugar de tener su propia capa, se vuelve a cargar conservando tok2vec.
+    Si el modelo no incluye senter, se usa el "sentencizer" basado en reglas. Los flags
+    is_space, is_punct y like_num son léxicos y no necesitan ningún componente.
+    """
+    import spacy
+    from spacy.cli import download
+
+    # Cargar el modelo de spaCy para el chunking (si no está instalado, se descarga)
+    try:
+        model = spacy.load(model_name, exclude=SPACY_EXCLUDE)
+    except OSError:
+        print(f"Model '{model_name}' not found. Downloading now...")
+        download(model_name)
+        model = spacy.load(model_name, exclude=SPACY_EXCLUDE)
+    if _senter_listens_to_tok2vec(model):
+        model = spacy.load(model_name, exclude=[name for name in SPACY_EXCLUDE if name != "tok2vec"])
+    if "senter" in model.disabled:
+        model.enable_pipe("senter")
+    elif "senter" not in model.pipe_names:
+        model.add_pipe("sentencizer")
+    return model
+
+
+def _senter_listens_to_tok2vec(model) -> bool:
+    # Un senter con capa propia no contiene ningún Tok2VecListener en su modelo
+    if "senter" not in model.component_names:
+        return False
+    senter = model.get_pipe("senter")
+    return any(node.name == "tok2vec-listener" for node in senter.model.walk())
+
+
+_nlp = None
+_tokenizer = None
+_nlp_lock = threading.Lock()
+
+
+def get_nlp():
+    """
+    Devuelve el pipeline de spaCy para el chunking (se carga en el primer uso).
+    """
+    global _nlp
+    if _nlp is None:
+        with _nlp_lock:
+            if _nlp is None:
+                _nlp = load_spacy_model()
+    return _nlp
 
-try:
-    nlp = spacy.load("en_core_web_sm")
-except OSError:
-    print("Model 'en_core_web_sm' not found. Downloading now...")
-    download("en_core_web_sm")
-    nlp = spacy.load("en_core_web_sm")
 
+def get_tokenizer():
+    """
+    Tokenizador inglés de spaCy sin modelo (para las consultas léxicas). Aplica las mismas
+    reglas y flags léxicos que el tokenizador de en_core_web_sm, sin cargar sus pesos.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        with _nlp_lock:
+            if _tokenizer is None:
+                import spacy
+                _tokenizer = spacy.blank("en").tokenizer
+    return _tokenizer
 
-def spacy_chunk_text(text: str, chunk_size: int = CHUNK_SIZE) -> list:
+
+class RetrievalEngine:
     """
-    Divide el texto en fragmentos basándose en la segmentación de oraciones de spaCy.
-    
+    Motor de recuperación residente: carga una sola vez el almacén vectorial y el modelo
+    de embeddings, y mantiene una caché LRU de embeddings de consultas.
+
     Args:
-        text (str): Texto a dividir.
-        chunk_size (int): Número máximo de caracteres por fragmento.
-        
+        persist_directory (str): Directorio de persistencia de ChromaDB.
+        model_name (str): Nombre del modelo de SentenceTransformer.
+        collection_name (str): Nombre de la colección de ChromaDB.
+        device (str): Dispositivo donde se carga el modelo (por defecto, cuda si está disponible).
+        cache_size (int): Número máximo de embeddings de consultas en caché.
+        lexical_directory (str): Directorio del índice léxico BM25.
+        vector_backend (str): "chroma" o "numpy".
+        vector_directory (str): Directorio del almacén NumPy (backend "numpy").
+        batch_max_size (int): Consultas concurrentes máximas por lote (ver src/batching.py).
+        batch_max_wait (float): Segundos que se espera a otras consultas antes de procesar un lote.
+    """
+
+    def __init__(self, persist_directory: str = PERSIST_DIRECTORY, model_name: str = MODEL_NAME,
+                 collection_name: str = COLLECTION_NAME, device: str = None,
+                 cache_size: int = QUERY_CACHE_SIZE, lexical_directory: str = LEXICAL_DIRECTORY,
+                 vector_backend: str = VECTOR_BACKEND, vector_directory: str = NUMPY_STORE_DIRECTORY,
+                 batch_max_size: int = BATCH_MAX_SIZE, batch_max_wait: float = BATCH_MAX_WAIT):
+        self.persist_directory = persist_directory
+        self.vector_backend = vector_backend
+        self.vector_directory = vector_directory
+        self.lexical_index = LexicalIndex(lexical_directory)
+        self.model_name = model_name
+        self.collection_name = collection_name
+        self._device = device
+        self.cache_size = cache_size
+        self._client = None
+        self._collection = None
+        self._model = None
+        self._query_cache = OrderedDict()
+        self._lock = threading.Lock()
+        # Hilos para lanzar la búsqueda léxica en paralelo con la densa
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="retrieval")
+        # Las consultas concurrentes de varias sesiones se agrupan en una sola llamada
+        # al modelo y en una sola consulta al almacén vectorial
+        self._encode_batcher = MicroBatcher(self._encode_batch, max_batch_size=batch_max_size,
+                                            max_wait=batch_max_wait, name="encode-batcher")
+        self._query_batcher = MicroBatcher(self._query_batch, max_batch_size=batch_max_size,
+                                           max_wait=batch_max_wait, name="query-batcher")
+
+    @property
+    def device(self) -> str:
+        if self._device is None:
+            self._device = default_device()
+        return self._device
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import chromadb
+                    self._client = chromadb.PersistentClient(path=self.persist_directory)
+        return self._client
+
+    @property
+    def collection(self):
+        """
+        Almacén vectorial (colección de ChromaDB o NumpyVectorStore, con la misma API).
+        """
+        if self._collection is None:
+            client = self.client if self.vector_backend == "chroma" else None
+            with self._lock:
+                if self._collection is None:
+                    self._collection = create_vector_store(
+                        self.vector_backend, client=client, collection_name=self.collection_name,
+                        directory=self.vector_directory, dtype=NUMPY_STORE_DTYPE,
+                    )
+        return self._collection
+
+    @property
+    def store_directory(self) -> str:
+        # Directorio del almacén activo (ahí se guarda también el manifiesto de ingesta)
+        return self.persist_directory if self.vector_backend == "chroma" else self.vector_directory
+
+    @property
+    def embedding_model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+                    print(f"Cargando el modelo de embeddings '{self.model_name}' en {self.device}...")
+                    self._model = SentenceTransformer(self.model_name, device=self.device)
+        return self._model
+
+    def warmup(self) -> None:
+        """
+        Carga el cliente, la colección y el modelo, y ejecuta una codificación de prueba
+        para que la primera consulta no pague el coste de inicialización.
+        """
+        self.collection
+        self.embedding_model.encode("warmup", show_progress_bar=False)
+
+    def encode_documents(self, texts: list, batch_size: int = 32, show_progress_bar: bool = True) -> list:
+        """
+        Genera los embeddings de una lista de fragmentos (sin pasar por la caché).
+        """
+        return self.embedding_model.encode(texts, batch_size=batch_size, show_progress_bar=show_progress_bar).tolist()
+
+    def encode_query(self, query: str) -> list:
+        """
+        Devuelve el embedding de una consulta, usando la caché LRU si ya se ha calculado.
+        """
+        with self._lock:
+            cached = self._query_cache.get(query)
+            if cached is not None:
+                self._query_cache.move_to_end(query)
+                metrics.inc("rag_cache_requests_total", cache="query_embedding", result="hit")
+                return cached
+
+        metrics.inc("rag_cache_requests_total", cache="query_embedding", result="miss")
+        with metrics.span("embed_query"):
+            embedding = self._encode_batcher(query)
+
+        with self._lock:
+            self._query_cache[query] = embedding
+            self._query_cache.move_to_end(query)
+            while len(self._query_cache) > self.cache_size:
+                self._query_cache.popitem(last=False)
+        return embedding
+
+    def _encode_batch(self, queries: list, key=None) -> list:
+        return self.embedding_model.encode(queries, batch_size=len(queries), show_progress_bar=False).tolist()
+
+    def query_embeddings(self, query_embedding: list, n_results: int, where: dict = None,
+                         include: list = None) -> dict:
+        """
+        Consulta el almacén vectorial con un embedding. Las consultas concurrentes con los
+        mismos parámetros se resuelven con una sola llamada a collection.query.
+
+        Returns:
+            dict: Resultados de la consulta (una lista por campo, sin el nivel por consulta).
+        """
+        key = (n_results, json.dumps(where, sort_keys=True), tuple(include or ()))
+        return self._query_batcher(query_embedding, key)
+
+    def _query_batch(self, query_embeddings: list, key) -> list:
+        n_results, where, include = key
+        resultados = self.collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            where=json.loads(where),
+            include=list(include)
+        )
+        return [
+            {field: list(resultados[field][i]) for field in ("ids",) + include}
+            for i in range(len(query_embeddings))
+        ]
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._query_cache.clear()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_retrieval_engine() -> RetrievalEngine:
+    """
+    Devuelve la instancia compartida del motor de recuperación (se crea en el primer uso).
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = RetrievalEngine()
+    return _engine
+
+
+def _chunk_sentences(doc, chunk_size: int = CHUNK_SIZE):
+    """
+    Agrupa las oraciones de un Doc de spaCy ya procesado en fragmentos de como máximo
+    chunk_size caracteres.
+
     Returns:
-        List[str]: Lista de fragmentos.
+        List[Tuple[str, List[Span]]]: Pares (texto del fragmento, oraciones que lo forman).
     """
-    doc = nlp(text)
-    sentences = [sent.text.strip() for sent in doc.sents]
     chunks = []
     current_chunk = ""
-    for sentence in sentences:
+    current_sents = []
+    for sent in doc.sents:
+        sentence = sent.text.strip()
         # Si al agregar la oración no se supera el límite, se concatena
         if len(current_chunk) + len(sentence) + 1 <= chunk_size:
             current_chunk = f"{current_chunk} {sentence}".strip() if current_chunk else sentence
+            current_sents.append(sent)
         else:
             # Se guarda el fragmento actual y se inicia uno nuevo con la oración
-            chunks.append(current_chunk)
+            chunks.append((current_chunk, current_sents))
             current_chunk = sentence
+            current_sents = [sent]
     if current_chunk:
-        chunks.append(current_chunk)
+        chunks.append((current_chunk, current_sents))
     return chunks
 
 
-def is_low_semantic_content(text: str, token_threshold: float = 0.35, min_sentences: int = 2, min_avg_tokens: int = 5) -> bool:
+def spacy_chunk_text(text: str, chunk_size: int = CHUNK_SIZE) -> list:
     """
-    Determina si un fragmento de texto tiene bajo contenido semántico.
+    Divide el texto en fragmentos basándose en la segmentación de oraciones de spaCy.
     
     Args:
-        text (str): Fragmento de texto a evaluar.
-        token_threshold (float): Proporción mínima de tokens significativos.
-        min_sentences (int): Número mínimo de oraciones.
-        min_avg_tokens (int): Número mínimo promedio de tokens por oración.
+        text (str): Texto a dividir.
+        chunk_size (int): Número máximo de caracteres por fragmento.
         
     Returns:
-        bool: True si el fragmento es considerado de bajo contenido, False en caso contrario.
+        List[str]: Lista de fragmentos.
+    """
+    return [chunk for chunk, _ in _chunk_sentences(get_nlp()(text), chunk_size=chunk_size)]
+
+
+def _is_low_semantic_sentences(sentences: list, token_threshold: float = 0.35, min_sentences: int = 2, min_avg_tokens: int = 5) -> bool:
+    """
+    Evalúa el contenido semántico a partir de las oraciones (Span) ya procesadas por spaCy,
+    sin volver a ejecutar el pipeline.
     """
-    doc = nlp(text)
-    sentences = list(doc.sents)
-    
     # Si hay pocas oraciones, puede ser un índice o anexo
     if len(sentences) < min_sentences:
         return True
 
     # Filtrar tokens significativos (excluyendo puntuación y números)
-    total_tokens = [token for token in doc if not token.is_space]
-    significant_tokens = [token for token in total_tokens if not token.is_punct and not token.like_num]
+    total_tokens = 0
+    significant_tokens = 0
+    for sent in sentences:
+        for token in sent:
+            if token.is_space:
+                continue
+            total_tokens += 1
+            if not token.is_punct and not token.like_num:
+                significant_tokens += 1
 
     if not total_tokens:
         return True  # Fragmento vacío
 
-    ratio_significant = len(significant_tokens) / len(total_tokens)
-    avg_tokens_per_sentence = sum(len([t for t in sent if not t.is_space]) for sent in sentences) / len(sentences)
+    ratio_significant = significant_tokens / total_tokens
+    avg_tokens_per_sentence = total_tokens / len(sentences)
 
     if ratio_significant < token_threshold or avg_tokens_per_sentence < min_avg_tokens:
         return True
@@ -90,149 +367,574 @@ def is_low_semantic_content(text: str, token_threshold: float = 0.35, min_senten
     return False
 
 
-def nlp_split_documents(documentos, chunk_size: int = CHUNK_SIZE):
+def is_low_semantic_content(text: str, token_threshold: float = 0.35, min_sentences: int = 2, min_avg_tokens: int = 5) -> bool:
+    """
+    Determina si un fragmento de texto tiene bajo contenido semántico.
+    
+    Args:
+        text (str): Fragmento de texto a evaluar.
+        token_threshold (float): Proporción mínima de tokens significativos.
+        min_sentences (int): Número mínimo de oraciones.
+        min_avg_tokens (int): Número mínimo promedio de tokens por oración.
+        
+    Returns:
+        bool: True si el fragmento es considerado de bajo contenido, False en caso contrario.
+    """
+    doc = get_nlp()(text)
+    return _is_low_semantic_sentences(
+        list(doc.sents),
+        token_threshold=token_threshold,
+        min_sentences=min_sentences,
+        min_avg_tokens=min_avg_tokens,
+    )
+
+
+def _keep_lexical_token(token) -> bool:
+    # Se conservan números y símbolos (unidades, variables); se descartan espacios, puntuación y stop words
+    return not (token.is_space or token.is_punct or token.is_stop)
+
+
+def lexical_query_tokens(text: str) -> list:
+    """
+    Tokens normalizados de una consulta para el índice BM25. Solo usa el tokenizador de
+    spaCy, que produce los mismos tokens que el pipeline completo usado en la ingesta.
+    """
+    return [token.lower_ for token in get_tokenizer()(text) if _keep_lexical_token(token)]
+
+
+def iter_split_documents(documentos, chunk_size: int = CHUNK_SIZE, batch_size: int = SPACY_BATCH_SIZE,
+                         with_tokens: bool = False):
+    """
+    Versión perezosa de nlp_split_documents: devuelve los fragmentos según se generan,
+    sin acumular el documento completo.
+
+    Args:
+        with_tokens (bool): Si es True, añade a la metadata de cada fragmento la lista
+            "tokens" (normalizados para el índice léxico) sacada de los tokens ya procesados.
+    """
+    from langchain.docstore.document import Document  # Para crear nuevos documentos
+
+    # Obtener el número de página del documento (suponiendo que esté en la metadata)
+    pages = ((doc.page_content, doc.metadata.get("page", "N/A")) for doc in documentos)
+    for parsed, page in get_nlp().pipe(pages, as_tuples=True, batch_size=batch_size):
+        for chunk, sentences in _chunk_sentences(parsed, chunk_size=chunk_size):
+            # Descartar fragmentos con bajo contenido semántico
+            if _is_low_semantic_sentences(sentences):
+                continue
+            # Crear un nuevo documento conservando la metadata (aquí solo la página)
+            metadata = {"page": page}
+            if with_tokens:
+                metadata["tokens"] = [t.lower_ for sent in sentences for t in sent if _keep_lexical_token(t)]
+            yield Document(page_content=chunk, metadata=metadata)
+
+
+def nlp_split_documents(documentos, chunk_size: int = CHUNK_SIZE, batch_size: int = SPACY_BATCH_SIZE):
     """
     Aplica el chunking basado en spaCy a cada documento, filtra fragmentos con bajo contenido semántico
     y devuelve una lista de nuevos Document.
+
+    Cada página se procesa una sola vez (en lotes con nlp.pipe) y el filtrado reutiliza
+    las oraciones y tokens ya calculados.
     
     Args:
         documentos (List[Document]): Documentos originales.
         chunk_size (int): Número máximo de caracteres por fragmento.
+        batch_size (int): Número de páginas por lote en nlp.pipe.
         
     Returns:
         List[Document]: Lista de documentos con fragmentos generados.
     """
-    new_docs = []
-    for doc in documentos:
-        # Obtener el número de página del documento (suponiendo que esté en la metadata)
-        page = doc.metadata.get("page", "N/A")
-        # Generar fragmentos usando spaCy
-        chunks = spacy_chunk_text(doc.page_content, chunk_size=chunk_size)
-        for chunk in chunks:
-            # Descartar fragmentos con bajo contenido semántico
-            if is_low_semantic_content(chunk):
-                continue
-            # Crear un nuevo documento conservando la metadata (aquí solo la página)
-            new_docs.append(Document(page_content=chunk, metadata={"page": page}))
-    return new_docs
+    return list(iter_split_documents(documentos, chunk_size=chunk_size, batch_size=batch_size))
+
+
+def module_for_source(pdf_file: str) -> str:
+    """
+    Devuelve el área de física de un PDF según SOURCE_MODULES (GENERAL_MODULE si no aparece).
+    """
+    name = os.path.basename(pdf_file).lower()
+    for key, module in SOURCE_MODULES.items():
+        key = key.lower()
+        # "notes.pdf" no debe etiquetar cualquier "*notes.pdf"
+        if name == key if key.endswith(".pdf") else key in name:
+            return module
+    return GENERAL_MODULE
+
+
+def _iter_pdf_chunk_batches(pdf_path: str, normalized_path: str, chunk_size: int = CHUNK_SIZE,
+                            batch_size: int = INGEST_BATCH_SIZE, start: int = 0, content_hash: str = None,
+                            text_cache_directory: str = TEXT_CACHE_DIRECTORY):
+    """
+    Carga un PDF página a página, lo fragmenta con spaCy y devuelve lotes de textos
+    limpios con sus metadatos. Solo hay en memoria un lote a la vez.
 
+    El texto de las páginas se lee de la caché de extracción (src/text_cache.py) si el PDF
+    ya se parseó antes; si no, se parsea y se guarda en ella.
 
-def preprocess_pdf_directory(pdf_directory: str) -> None:
+    Args:
+        start (int): Número de fragmentos ya confirmados en una ingesta anterior; se
+            descartan para reanudar desde el último lote escrito (el chunking es determinista).
+        content_hash (str): SHA-256 del PDF (se calcula si no se indica).
+        text_cache_directory (str): Directorio de la caché de texto extraído.
+
+    Yields:
+        Tuple[List[str], List[dict], List[List[str]], dict]: (textos, metadatos, tokens léxicos,
+        estadísticas) de como máximo batch_size fragmentos. Las estadísticas son las páginas
+        leídas y los segundos de parseo (load_seconds) y de chunking (chunk_seconds) del lote.
+    """
+    text_cache = PageTextCache(text_cache_directory)
+    content_hash = content_hash or file_sha256(pdf_path)
+    module = module_for_source(os.path.basename(pdf_path))
+    # Tiempos del lote actual: la lectura de páginas se mide página a página y el resto del
+    # tiempo del generador (entre dos lotes) es chunking con spaCy
+    stats = {"pages": 0, "load_seconds": 0.0}
+
+    def timed_pages():
+        pages = text_cache.iter_pages(pdf_path, content_hash)
+        while True:
+            page_start = time.perf_counter()
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            finally:
+                stats["load_seconds"] += time.perf_counter() - page_start
+            stats["pages"] += 1
+            yield page
+
+    def batch_stats(batch_start: float) -> dict:
+        elapsed = time.perf_counter() - batch_start
+        result = dict(stats, chunk_seconds=max(0.0, elapsed - stats["load_seconds"]))
+        stats.update(pages=0, load_seconds=0.0)
+        return result
+
+    texts, metadatas, token_lists = [], [], []
+    batch_start = time.perf_counter()
+    for i, frag in enumerate(iter_split_documents(timed_pages(), chunk_size=chunk_size, with_tokens=True)):
+        if i < start:
+            continue
+        # Limpiar fragmentos: reemplazar saltos de línea por espacios
+        texts.append(frag.page_content.replace("\n", " "))
+        metadatas.append({"source": normalized_path, "page": frag.metadata.get("page", "N/A"), "module": module})
+        token_lists.append(frag.metadata["tokens"])
+        if len(texts) >= batch_size:
+            yield texts, metadatas, token_lists, batch_stats(batch_start)
+            texts, metadatas, token_lists = [], [], []
+            batch_start = time.perf_counter()
+    if texts or stats["pages"]:
+        # El último lote puede quedar vacío (páginas finales sin contenido útil): solo lleva estadísticas
+        yield texts, metadatas, token_lists, batch_stats(batch_start)
+
+
+def _record_parse_stats(stats: dict, n_chunks: int) -> None:
+    """
+    Registra las métricas de parseo y chunking de un lote (medidas en el proceso que lo generó).
+    """
+    metrics.observe("rag_stage_seconds", stats["load_seconds"], stage="pdf_load")
+    metrics.observe("rag_stage_seconds", stats["chunk_seconds"], stage="chunking")
+    metrics.inc("rag_ingest_pages_total", stats["pages"])
+    metrics.inc("rag_ingest_chunks_total", n_chunks)
+
+
+def _report_file_throughput(pdf_file: str, pages: int, chunks: int, seconds: float) -> None:
+    seconds = max(seconds, 1e-9)
+    metrics.inc("rag_ingest_files_total")
+    metrics.log("ingest_file", file=pdf_file, pages=pages, chunks=chunks, seconds=round(seconds, 3),
+                pages_per_second=round(pages / seconds, 2), chunks_per_second=round(chunks / seconds, 2))
+    print(f"{pdf_file}: {pages} páginas y {chunks} fragmentos en {seconds:.1f}s "
+          f"({pages / seconds:.1f} páginas/s, {chunks / seconds:.1f} fragmentos/s).")
+
+
+def _upsert_batch(engine, collection, pdf_file: str, texts: list, metadatas: list, token_lists: list,
+                  start: int) -> int:
+    """
+    Genera los embeddings de un lote y lo escribe en ChromaDB con ids deterministas
+    ({pdf_file}_doc_{i}), y añade sus tokens al índice léxico. Al usar upsert, repetir
+    un lote tras un fallo es idempotente.
+
+    Returns:
+        int: Número total de fragmentos escritos para el archivo tras este lote.
+    """
+    if not texts:
+        return start
+    ids = [f"{pdf_file}_doc_{i}" for i in range(start, start + len(texts))]
+    with metrics.span("embed_documents"):
+        embeddings = engine.encode_documents(texts, batch_size=32, show_progress_bar=False)
+    with metrics.span("store_upsert"):
+        collection.upsert(
+            documents=texts,
+            embeddings=embeddings,
+            metadatas=metadatas,
+            ids=ids,
+        )
+    with metrics.span("lexical_add"):
+        engine.lexical_index.add_batch(metadatas[0]["source"], ids, token_lists, [m["module"] for m in metadatas])
+    return start + len(texts)
+
+
+def _backfill_lexical_segment(engine, collection, source: str) -> None:
+    """
+    Crea el segmento léxico de un PDF ya indexado antes de existir el índice léxico,
+    tokenizando los fragmentos guardados en ChromaDB (sin recalcular embeddings).
+    """
+    datos = collection.get(where={"source": source}, include=["documents", "metadatas"])
+    if not datos["ids"]:
+        return
+    token_lists = [lexical_query_tokens(doc) for doc in datos["documents"]]
+    modules = [meta.get("module", GENERAL_MODULE) for meta in datos["metadatas"]]
+    engine.lexical_index.add_batch(source, datos["ids"], token_lists, modules)
+
+
+# Cola compartida con el proceso principal y señal de cancelación (se asignan en cada worker al arrancar)
+_worker_queue = None
+_worker_cancel = None
+CANCEL_DRAIN_TIMEOUT = 30  # Segundos máximos esperando a que los workers paren tras un error
+
+
+def _init_ingest_worker(result_queue, cancel_event) -> None:
+    global _worker_queue, _worker_cancel
+    _worker_queue = result_queue
+    _worker_cancel = cancel_event
+
+
+def _put_message(message) -> bool:
+    """
+    Envía un mensaje al consumidor. Mientras la cola está llena se reintenta, salvo que el
+    consumidor haya cancelado la ingesta.
+
+    Returns:
+        bool: False si la ingesta se ha cancelado y el mensaje no se ha enviado.
+    """
+    while not _worker_cancel.is_set():
+        try:
+            _worker_queue.put(message, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _ingest_worker(pdf_file: str, pdf_path: str, normalized_path: str, chunk_size: int, batch_size: int,
+                   start: int = 0, content_hash: str = None, text_cache_directory: str = TEXT_CACHE_DIRECTORY) -> None:
+    """
+    Tarea ejecutada en un proceso del pool: parsea y fragmenta un PDF y envía los lotes
+    a la cola. put() espera cuando la cola está llena, así que un libro grande no puede
+    acumular más de queue_size lotes en memoria. Si el consumidor cancela la ingesta, la
+    tarea termina sin enviar más lotes.
+    """
+    try:
+        for batch in _iter_pdf_chunk_batches(pdf_path, normalized_path, chunk_size, batch_size, start, content_hash,
+                                             text_cache_directory):
+            if not _put_message(("batch", pdf_file, batch)):
+                return
+        _put_message(("done", pdf_file, None))
+    except Exception as e:
+        _put_message(("error", pdf_file, repr(e)))
+
+
+def _cancel_workers(pool, futures: list, result_queue, cancel_event) -> None:
+    """
+    Detiene los workers tras un error en el consumidor: marca la cancelación, vacía la cola
+    (un worker bloqueado en put() o con mensajes aún en su buffer no podría terminar) y
+    cierra el pool sin lanzar las tareas pendientes.
+    """
+    cancel_event.set()
+    for future in futures:
+        future.cancel()
+    deadline = time.monotonic() + CANCEL_DRAIN_TIMEOUT
+    while not all(f.done() for f in futures) and time.monotonic() < deadline:
+        try:
+            result_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _ingest_parallel(engine, collection, manifest, pending: list, workers: int, chunk_size: int = CHUNK_SIZE,
+                     batch_size: int = INGEST_BATCH_SIZE, queue_size: int = None,
+                     text_cache_directory: str = TEXT_CACHE_DIRECTORY) -> None:
+    """
+    Reparte el parseo y el chunking de los PDFs entre varios procesos. El proceso principal
+    actúa como único consumidor: toma lotes de una cola acotada, genera los embeddings y
+    los escribe en ChromaDB.
+
+    Si el consumidor falla (o se interrumpe con Ctrl+C), se cancelan los workers antes de
+    propagar el error; los lotes ya confirmados en el manifiesto se reanudan en la siguiente
+    ingesta.
+
+    Args:
+        pending (List[Tuple[str, str, str, int, str]]): (nombre, ruta, ruta normalizada, fragmentos
+            ya confirmados, hash del contenido) de cada PDF.
+        workers (int): Número de procesos.
+        queue_size (int): Máximo de lotes en la cola (por defecto 2 por worker).
+    """
+    ctx = multiprocessing.get_context()
+    result_queue = ctx.Queue(maxsize=queue_size or 2 * workers)
+    cancel_event = ctx.Event()
+    counters = {pdf_file: start for pdf_file, _, _, start, _ in pending}
+    # Páginas y fragmentos nuevos de cada archivo, para el rendimiento por archivo
+    throughput = {pdf_file: [0, 0] for pdf_file in counters}
+    sources = {pdf_file: normalized_path for pdf_file, _, normalized_path, _, _ in pending}
+    remaining = set(counters)
+
+    print(f"Procesando {len(pending)} archivos con {workers} procesos...")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_ingest_worker,
+                             initargs=(result_queue, cancel_event)) as pool:
+        futures = [
+            pool.submit(_ingest_worker, pdf_file, pdf_path, normalized_path, chunk_size, batch_size, start,
+                        content_hash, text_cache_directory)
+            for pdf_file, pdf_path, normalized_path, start, content_hash in pending
+        ]
+        started = time.perf_counter()
+        drained = False
+        try:
+            while remaining:
+                try:
+                    kind, pdf_file, payload = result_queue.get(timeout=1)
+                except queue.Empty:
+                    if all(f.done() for f in futures):
+                        # Un worker terminado puede tener aún mensajes en tránsito: un último intento
+                        if drained:
+                            break
+                        drained = True
+                    continue
+                drained = False
+
+                if kind == "batch":
+                    texts, metadatas, token_lists, stats = payload
+                    _record_parse_stats(stats, len(texts))
+                    throughput[pdf_file][0] += stats["pages"]
+                    throughput[pdf_file][1] += len(texts)
+                    counters[pdf_file] = _upsert_batch(engine, collection, pdf_file, texts, metadatas, token_lists,
+                                                       counters[pdf_file])
+                    manifest.commit_batch(sources[pdf_file], counters[pdf_file])
+                elif kind == "done":
+                    remaining.discard(pdf_file)
+                    manifest.finish(sources[pdf_file])
+                    print(f"Proceso completado para el archivo: {pdf_file} ({counters[pdf_file]} fragmentos).")
+                    # Tiempo de pared desde el reparto (los archivos se procesan a la vez)
+                    _report_file_throughput(pdf_file, *throughput[pdf_file], time.perf_counter() - started)
+                else:
+                    remaining.discard(pdf_file)
+                    print(f"Error al procesar '{pdf_file}': {payload}")
+        except BaseException:
+            print("Error en la ingesta. Deteniendo los procesos...")
+            _cancel_workers(pool, futures, result_queue, cancel_event)
+            raise
+
+    for pdf_file in remaining:
+        print(f"El procesamiento de '{pdf_file}' terminó sin completarse.")
+
+
+def preprocess_pdf_directory(pdf_directory: str, workers: int = INGEST_WORKERS, chunk_size: int = CHUNK_SIZE,
+                             batch_size: int = INGEST_BATCH_SIZE,
+                             text_cache_directory: str = TEXT_CACHE_DIRECTORY) -> None:
     """
     Preprocesa todos los documentos PDF en un directorio: carga, divide en fragmentos (usando spaCy para chunking),
     limpia el texto, genera embeddings y almacena la información en ChromaDB.
+
+    La ingesta funciona como un pipeline de generadores (páginas → fragmentos → lotes de
+    embeddings → upserts), de modo que la memoria depende de batch_size y no del tamaño del
+    documento. Tras cada lote se actualiza el manifiesto, y una ingesta interrumpida se
+    reanuda desde el último lote confirmado.
+
+    Con workers > 1 y varios PDFs pendientes, el parseo y el chunking se reparten entre
+    procesos y los embeddings se generan en un único consumidor.
+
+    El texto de cada PDF se extrae una sola vez y se guarda por hash del contenido en
+    text_cache_directory: re-indexar con otro chunk_size, otros filtros u otro modelo no
+    vuelve a parsear los PDFs.
     
     Args:
         pdf_directory (str): Ruta al directorio con archivos PDF.
+        workers (int): Número de procesos para parsear y fragmentar PDFs.
+        chunk_size (int): Número máximo de caracteres por fragmento.
+        batch_size (int): Número de fragmentos por lote de embeddings y escritura.
+        text_cache_directory (str): Directorio de la caché de texto extraído.
     """
-    # Inicializar el cliente persistente de ChromaDB y la colección
-    client = chromadb.PersistentClient(path=PERSIST_DIRECTORY)
-    collection = client.get_or_create_collection(name=COLLECTION_NAME)
+    # Reutilizar el cliente de ChromaDB y la colección del motor compartido
+    engine = get_retrieval_engine()
+    collection = engine.collection
 
     # Listar todos los archivos PDF en el directorio
     pdf_files = [f for f in os.listdir(pdf_directory) if f.endswith('.pdf')]
     if not pdf_files:
+        # Sin salir todavía: los fragmentos de PDFs borrados se eliminan igualmente
         print("No se encontraron archivos PDF en el directorio.")
-        return
-    
+
+    # El manifiesto decide qué archivos se omiten, se reanudan, se re-indexan o se borran
+    manifest = IngestManifest(engine.store_directory)
+
+    lexical_changed = False
+    # Hashes de versiones anteriores de PDFs borrados o modificados (su texto en caché ya no sirve)
+    stale_hashes = set()
+
+    # Normalizamos las rutas para que sean iguales que en las metadatas
+    normalized_dir = os.path.normpath(pdf_directory).replace("\\", "/")
+    present = {os.path.join(pdf_directory, f).replace("\\", "/") for f in pdf_files}
+    for source in manifest.sources():
+        if os.path.dirname(os.path.normpath(source)).replace("\\", "/") == normalized_dir and source not in present:
+            print(f"'{source}' ya no existe. Eliminando sus fragmentos...")
+            stale_ids = manifest.stale_ids(source)
+            if stale_ids:
+                collection.delete(ids=stale_ids)
+            engine.lexical_index.remove_source(source)
+            stale_hashes.add(manifest.entries[source].get("sha256"))
+            manifest.remove(source)
+            lexical_changed = True
+
+    pending = []
     for pdf_file in pdf_files:
         pdf_path = os.path.join(pdf_directory, pdf_file)
+        normalized_path = pdf_path.replace("\\", "/")
+        # El módulo forma parte de los parámetros: si cambia la asignación, se re-indexa el archivo
+        params = {"chunk_size": chunk_size, "model": engine.model_name, "module": module_for_source(pdf_file)}
 
-        # Normalizamos la ruta para que sea igual que en las metadatas
-        normalized_path = pdf_path.replace("\\", "/")        
-        existing_embeddings = collection.get(
-            where={"source": normalized_path},
-            include=["documents"]
-        )
-        if len(existing_embeddings["documents"]) > 0:
+        action = manifest.plan(normalized_path, pdf_path, params)
+        if action == "skip":
             print(f"Embeddings ya existen para {pdf_file}. Se omite el procesamiento.\n")
+            if not engine.lexical_index.has_source(normalized_path):
+                _backfill_lexical_segment(engine, collection, normalized_path)
+                lexical_changed = True
+            continue
+        if action == "resume":
+            start = manifest.entries[normalized_path]["n_chunks"]
+            print(f"Reanudando {pdf_file} desde el fragmento {start}.")
+            content_hash = manifest.content_hash(normalized_path, pdf_path)
+            pending.append((pdf_file, pdf_path, normalized_path, start, content_hash))
             continue
+        if action == "reindex":
+            # Contenido o parámetros distintos: borrar los fragmentos anteriores
+            print(f"{pdf_file} ha cambiado. Se vuelve a indexar.")
+            stale_hashes.add(manifest.entries[normalized_path].get("sha256"))
+            stale_ids = manifest.stale_ids(normalized_path)
+            if stale_ids:
+                collection.delete(ids=stale_ids)
         else:
+            # Sin entrada en el manifiesto: limpiar posibles fragmentos de una ingesta anterior al manifiesto
+            collection.delete(where={"source": normalized_path})
+        engine.lexical_index.remove_source(normalized_path)
+        manifest.start(normalized_path, pdf_file, pdf_path, params)
+        pending.append((pdf_file, pdf_path, normalized_path, 0, manifest.content_hash(normalized_path, pdf_path)))
+
+    if workers > 1 and len(pending) > 1:
+        _ingest_parallel(engine, collection, manifest, pending, min(workers, len(pending)),
+                         chunk_size=chunk_size, batch_size=batch_size, text_cache_directory=text_cache_directory)
+    else:
+        print(f"\nUsando dispositivo: {engine.device}")
+        for pdf_file, pdf_path, normalized_path, start, content_hash in pending:
             print(f"Procesando el archivo: {pdf_file} ...")
-        
-        # Función asíncrona para cargar el PDF
-        async def cargar_pdf(ruta: str):
-            print(f"Cargando el PDF: {ruta} ...")
-            loader = PyPDFLoader(ruta)
-            documentos = await loader.aload()
-            print(f"PDF cargado: {ruta}.")
-            return documentos
-
-        documentos = asyncio.run(cargar_pdf(pdf_path))
-
-        # Aplicar chunking basado en spaCy a cada documento y filtrar fragmentos irrelevantes
-        print("Dividiendo el contenido en fragmentos utilizando spaCy...")
-        fragmentos = nlp_split_documents(documentos, chunk_size=CHUNK_SIZE)
-        print(f"Se han generado {len(fragmentos)} fragmentos útiles.")
-
-        # Limpiar fragmentos: reemplazar saltos de línea por espacios
-        print("Limpiando fragmentos (reemplazando saltos de línea)...")
-        for frag in tqdm(fragmentos, desc="Limpiando fragmentos", unit="fragmento"):
-            frag.page_content = frag.page_content.replace("\n", " ")
-
-        # Extraer textos y preparar metadatos (incluyendo el número de página)
-        texts = [frag.page_content for frag in fragmentos]
-        metadatas = []
-        for frag in fragmentos:
-            meta = {"source": normalized_path, "page": frag.metadata.get("page", "N/A")}
-            metadatas.append(meta)
-
-        print(f"\nUsando dispositivo: {DEVICE}")
-
-        # Inicializar el modelo de embeddings
-        embedding_model = SentenceTransformer(MODEL_NAME, device=DEVICE)
+            n_chunks, n_pages, started = start, 0, time.perf_counter()
+            batches = _iter_pdf_chunk_batches(pdf_path, normalized_path, chunk_size, batch_size, start,
+                                              content_hash, text_cache_directory)
+            for texts, metadatas, token_lists, stats in tqdm(batches, desc=pdf_file, unit="lote"):
+                _record_parse_stats(stats, len(texts))
+                n_pages += stats["pages"]
+                n_chunks = _upsert_batch(engine, collection, pdf_file, texts, metadatas, token_lists, n_chunks)
+                manifest.commit_batch(normalized_path, n_chunks)
+            manifest.finish(normalized_path)
+            _report_file_throughput(pdf_file, n_pages, n_chunks - start, time.perf_counter() - started)
+
+            print(f"Proceso completado para el archivo: {pdf_file} ({n_chunks} fragmentos). Los embeddings se han generado y almacenado.\n")
+
+    # Compactar el índice léxico (y el almacén NumPy) si ha cambiado algún PDF
+    if pending or lexical_changed or not engine.lexical_index.exists():
+        with metrics.span("lexical_build"):
+            engine.lexical_index.build()
+        if hasattr(collection, "compact"):
+            with metrics.span("store_compact"):
+                collection.compact()
+
+    # El texto extraído de versiones borradas o modificadas ya no se puede reutilizar
+    stale_hashes -= {entry.get("sha256") for entry in manifest.entries.values()}
+    removed = PageTextCache(text_cache_directory).discard(stale_hashes - {None})
+    if removed:
+        print(f"Eliminadas {removed} entradas obsoletas de la caché de texto.")
 
-        print("\nGenerando embeddings...")
-        embeddings = embedding_model.encode(texts, batch_size=32, show_progress_bar=True).tolist()
+    print("Proceso completado para todos los archivos en el directorio.")
 
-        # Generar IDs únicos para cada fragmento
-        ids = [f"{pdf_file}_doc_{i}" for i in range(len(texts))]
 
-        print("Agregando documentos a la colección de ChromaDB...")
-        collection.add(
-            documents=texts,
-            embeddings=embeddings,
-            metadatas=metadatas,
-            ids=ids
-        )
+def _dense_search(engine, query_embedding: list, n_candidates: int, where: dict = None) -> dict:
+    include = ["documents", "metadatas", "distances", "embeddings"]
+    with metrics.span("vector_query"):
+        resultados = engine.query_embeddings(query_embedding, n_candidates, where=where, include=include)
+        if where and not resultados["documents"]:
+            resultados = engine.query_embeddings(query_embedding, n_candidates, include=include)
+    return resultados
 
-        print(f"Proceso completado para el archivo: {pdf_file}. Los embeddings se han generado y almacenado.\n")
 
-    print("Proceso completado para todos los archivos en el directorio.")
+def _lexical_search(engine, query: str, n_candidates: int, module: str = None) -> list:
+    with metrics.span("lexical_query"):
+        return engine.lexical_index.search(lexical_query_tokens(query), n_candidates, module)
 
 
-def query_vector_database(query: str) -> list:
+def query_vector_database(query: str, module: str = None, n_candidates: int = QUERY_CANDIDATES,
+                          max_tokens: int = CONTEXT_MAX_TOKENS) -> list:
     """
-    Realiza una consulta sobre la base de datos vectorial y muestra los fragmentos
-    más similares a la query ingresada.
+    Realiza una consulta híbrida (vectorial + léxica) y devuelve los fragmentos más
+    relevantes para la query ingresada.
+
+    La búsqueda BM25 sobre el índice léxico se lanza en paralelo con el embedding y la
+    consulta a ChromaDB, y ambas listas se combinan con reciprocal rank fusion. Si se indica
+    un módulo (distinto de GENERAL_MODULE), ambas búsquedas se limitan a sus fragmentos; si
+    el módulo no tiene fragmentos, se busca en toda la colección. Los candidatos se
+    empaquetan con pack_context: corte por distancia (solo para los que no encuentra BM25),
+    eliminación de duplicados, diversificación con MMR y presupuesto de tokens.
     
     Args:
         query (str): El prompt o consulta a buscar.
+        module (str): Área de física seleccionada.
+        n_candidates (int): Número de candidatos a recuperar de cada búsqueda.
+        max_tokens (int): Presupuesto de tokens del contexto.
     
     Returns:
-        list: Lista de fragmentos relevantes con metadatos.
+        list: Lista de fragmentos relevantes con su cita compacta.
     """
-    # Inicializar el cliente persistente y la colección
-    client = chromadb.PersistentClient(path=PERSIST_DIRECTORY)
-    collection = client.get_or_create_collection(name=COLLECTION_NAME)
-
-    # Inicializar el modelo de embeddings
-    embedding_model = SentenceTransformer(MODEL_NAME, device=DEVICE)
-
-    query_embedding = embedding_model.encode(query, show_progress_bar=False).tolist()
-
-    resultados = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=15,
-        include=["documents", "metadatas", "distances"]
+    # Reutilizar el motor residente (modelo, colección e índice léxico cargados una sola vez)
+    engine = get_retrieval_engine()
+    filtered = bool(module and module != GENERAL_MODULE)
+    lexical_future = engine.executor.submit(
+        _lexical_search, engine, query, n_candidates, module if filtered else None
     )
 
-    results = []
-    for idx, (doc, meta) in enumerate(zip(
-            resultados["documents"][0],
-            resultados["metadatas"][0])):
-        results.append(doc + " || FRAGMENT INFO: " + str(meta) + "||")
-    return results
+    query_embedding = engine.encode_query(query)
+    dense = _dense_search(engine, query_embedding, n_candidates, {"module": module} if filtered else None)
+    lexical_hits = lexical_future.result()
+
+    # Fusionar rankings; los fragmentos que solo encuentra BM25 se leen de ChromaDB
+    fused = reciprocal_rank_fusion([dense["ids"], [doc_id for doc_id, _ in lexical_hits]])[:n_candidates]
+    candidates = {doc_id: i for i, doc_id in enumerate(dense["ids"])}
+    missing = [doc_id for doc_id, _ in fused if doc_id not in candidates]
+    if missing:
+        with metrics.span("lexical_fetch"):
+            extra = engine.collection.get(ids=missing, include=["documents", "metadatas", "embeddings"])
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        for doc_id, doc, meta, embedding in zip(extra["ids"], extra["documents"], extra["metadatas"], extra["embeddings"]):
+            candidates[doc_id] = len(dense["ids"])
+            dense["ids"].append(doc_id)
+            dense["documents"].append(doc)
+            dense["metadatas"].append(meta)
+            dense["embeddings"].append(embedding)
+            # Distancia L2² (la métrica por defecto de la colección)
+            dense["distances"].append(float(np.sum((np.asarray(embedding, dtype=np.float32) - query_vector) ** 2)))
+
+    order = [candidates[doc_id] for doc_id, _ in fused if doc_id in candidates]
+    # Un acierto léxico no se descarta por la distancia de su embedding: BM25 ya lo avala
+    lexical_ids = {doc_id for doc_id, _ in lexical_hits}
+    with metrics.span("pack_context"):
+        context = pack_context(
+            [dense["documents"][i] for i in order],
+            [dense["metadatas"][i] for i in order],
+            [dense["distances"][i] for i in order],
+            [dense["embeddings"][i] for i in order],
+            query_embedding,
+            max_tokens=max_tokens,
+            scores=[score for doc_id, score in fused if doc_id in candidates],
+            exempt=[dense["ids"][i] in lexical_ids for i in order],
+        )
+    metrics.inc("rag_retrieval_candidates_total", len(order))
+    metrics.inc("rag_context_fragments_total", len(context))
+    metrics.inc("rag_tokens_total", sum(estimate_tokens(fragment) for fragment in context), kind="context")
+    return context
 
 
 def obtener_todos_los_sources() -> set:
@@ -242,17 +944,16 @@ def obtener_todos_los_sources() -> set:
     Returns:
         set: Un conjunto de sources únicos.
     """
-    client = chromadb.PersistentClient(path=PERSIST_DIRECTORY)
-    collection = client.get_or_create_collection(name=COLLECTION_NAME)
+    collection = get_retrieval_engine().collection
     
     datos = collection.get(include=["metadatas"])
     
     sources = set()
-    for metadata in datos["metadatas"]:
-        for meta in metadata:
-            source = meta.get("source")
-            if source:
-                sources.add(source)
+    # collection.get devuelve una lista plana de metadatos (un dict por fragmento)
+    for meta in datos["metadatas"]:
+        source = (meta or {}).get("source")
+        if source:
+            sources.add(source)
     
     print("\nSources almacenados en la colección:")
     for source in sorted(sources):
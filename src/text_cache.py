@@ -0,0 +1,95 @@
+import os
+import gzip
+import json
+
+from src.metrics import metrics
+
+TEXT_CACHE_DIRECTORY = "text_cache"  # Texto extraído de los PDFs, por hash del contenido
+
+
+class PageTextCache:
+    """
+    Caché en disco del texto extraído de cada PDF, indexada por el SHA-256 del contenido.
+
+    Cada PDF se guarda como un archivo JSON lines comprimido con gzip ({sha256}.jsonl.gz),
+    con una línea por página ({"page": n, "text": ...}), así que se puede leer página a
+    página sin cargar el libro entero. Cambiar el tamaño de los fragmentos, los filtros o el
+    modelo de embeddings vuelve a fragmentar desde esta caché sin parsear el PDF.
+
+    El archivo se escribe mientras se parsea el PDF y solo se activa (os.replace) al leer
+    la última página: una extracción interrumpida nunca deja una entrada incompleta.
+
+    Args:
+        directory (str): Directorio de la caché.
+    """
+
+    def __init__(self, directory: str = TEXT_CACHE_DIRECTORY):
+        self.directory = directory
+
+    def _path(self, content_hash: str) -> str:
+        return os.path.join(self.directory, f"{content_hash}.jsonl.gz")
+
+    def has(self, content_hash: str) -> bool:
+        return os.path.exists(self._path(content_hash))
+
+    def iter_pages(self, pdf_path: str, content_hash: str):
+        """
+        Devuelve las páginas del PDF como Document de langchain (con "source" y "page" en
+        los metadatos, igual que PyPDFLoader). Si el PDF no está en caché, lo parsea de forma
+        perezosa y guarda cada página según se extrae.
+
+        Yields:
+            Document: Una página del PDF.
+        """
+        from langchain_core.documents import Document
+
+        path = self._path(content_hash)
+        try:
+            f = gzip.open(path, "rt", encoding="utf-8")
+        except FileNotFoundError:
+            f = None
+        if f is not None:
+            metrics.inc("rag_cache_requests_total", cache="pdf_text", result="hit")
+            with f:
+                for line in f:
+                    entry = json.loads(line)
+                    yield Document(page_content=entry["text"], metadata={"source": pdf_path, "page": entry["page"]})
+            return
+
+        metrics.inc("rag_cache_requests_total", cache="pdf_text", result="miss")
+        yield from self._extract(pdf_path, path)
+
+    def _extract(self, pdf_path: str, path: str):
+        from langchain_community.document_loaders import PyPDFLoader
+
+        os.makedirs(self.directory, exist_ok=True)
+        # Nombre temporal por proceso: dos PDFs idénticos pueden extraerse a la vez
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        completed = False
+        try:
+            with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+                for page in PyPDFLoader(pdf_path).lazy_load():
+                    f.write(json.dumps({"page": page.metadata.get("page"), "text": page.page_content},
+                                       ensure_ascii=False) + "\n")
+                    yield page
+            completed = True
+            os.replace(tmp_path, path)
+        finally:
+            if not completed and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def discard(self, content_hashes) -> int:
+        """
+        Borra las entradas indicadas (PDFs que ya no existen o han cambiado).
+
+        Returns:
+            int: Número de entradas borradas.
+        """
+        removed = 0
+        for content_hash in content_hashes:
+            try:
+                os.remove(self._path(content_hash))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
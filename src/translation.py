@@ -0,0 +1,191 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from langdetect import DetectorFactory, detect
+from langdetect.lang_detect_exception import LangDetectException
+
+from src.metrics import metrics
+
+TARGET_LANGUAGE = "en"  # Idioma de los documentos (y del embedding)
+TRANSLATE_LANGUAGES = {"es"}  # Idiomas que se traducen antes de la búsqueda
+DEFAULT_LANGUAGE = "es"  # Idioma asumido si no se puede detectar
+TRANSLATION_TIMEOUT = 3.0  # Segundos antes de usar la pregunta sin traducir
+TRANSLATION_CACHE_SIZE = 2048  # Número máximo de preguntas en caché
+# "google" (deep_translator) o "google-web" (endpoint web no oficial, con timeout HTTP)
+TRANSLATION_BACKEND = os.getenv("TRANSLATION_BACKEND", "google")
+
+# langdetect es no determinista por defecto; fijamos la semilla para que la caché sea estable
+DetectorFactory.seed = 0
+
+
+class GoogleBackend:
+    """
+    Traducción con Google Translate a través de deep_translator (requiere red).
+
+    deep_translator no permite fijar un timeout a la petición: una llamada colgada ocupa
+    su hilo hasta que termine, pero TranslationStage deja de enviar traducciones cuando
+    todos sus hilos están ocupados.
+    """
+
+    def translate(self, text: str, source: str, target: str) -> str:
+        from deep_translator import GoogleTranslator
+        return GoogleTranslator(source=source, target=target).translate(text)
+
+
+class GoogleWebBackend:
+    """
+    Traducción con el endpoint web no oficial de Google Translate (requiere red). Es
+    opcional (TRANSLATION_BACKEND=google-web): el formato de la respuesta no está
+    documentado y puede cambiar, pero la petición HTTP lleva timeout.
+
+    Args:
+        timeout (float): Segundos máximos de la petición HTTP (conexión y lectura).
+    """
+
+    URL = "https://translate.googleapis.com/translate_a/single"
+
+    def __init__(self, timeout: float = TRANSLATION_TIMEOUT):
+        self.timeout = timeout
+        self._session = None
+
+    def translate(self, text: str, source: str, target: str) -> str:
+        import requests
+        if self._session is None:
+            self._session = requests.Session()
+        params = {"client": "gtx", "sl": source, "tl": target, "dt": "t", "q": text}
+        response = self._session.get(self.URL, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        # [[[traducción, original, ...], ...], ...]: un segmento por frase
+        return "".join(segment[0] for segment in response.json()[0] if segment[0])
+
+
+class IdentityBackend:
+    """
+    Backend local que no traduce: sirve como sustituto sin red (tests, modo offline).
+    """
+
+    def translate(self, text: str, source: str, target: str) -> str:
+        return text
+
+
+def create_translation_backend(name: str = TRANSLATION_BACKEND, timeout: float = TRANSLATION_TIMEOUT):
+    """
+    Crea el backend de traducción por nombre: "google", "google-web" o "identity".
+    """
+    if name == "google":
+        return GoogleBackend()
+    if name == "google-web":
+        return GoogleWebBackend(timeout=timeout)
+    if name == "identity":
+        return IdentityBackend()
+    raise ValueError(f"Backend de traducción desconocido: {name}")
+
+
+def normalize_question(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class TranslationStage:
+    """
+    Etapa de detección de idioma y traducción al inglés con caché acotada.
+
+    La caché guarda pregunta normalizada -> (idioma, texto en inglés). El backend es
+    cualquier objeto con un método translate(text, source, target); si tarda más de
+    timeout segundos o falla, se devuelve la pregunta original sin traducir. Si todos los
+    hilos del pool siguen ocupados con traducciones anteriores, no se encola la nueva: se
+    usa directamente la pregunta original.
+
+    Args:
+        backend: Backend de traducción (por defecto, el indicado en TRANSLATION_BACKEND).
+        timeout (float): Segundos máximos de espera por traducción.
+        cache_size (int): Número máximo de preguntas en caché.
+        max_workers (int): Traducciones simultáneas como máximo.
+    """
+
+    def __init__(self, backend=None, timeout: float = TRANSLATION_TIMEOUT,
+                 cache_size: int = TRANSLATION_CACHE_SIZE, max_workers: int = 4):
+        self.backend = backend or create_translation_backend(timeout=timeout)
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.max_workers = max_workers
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="translation")
+
+    @staticmethod
+    def detect_language(text: str) -> str:
+        try:
+            return detect(text)
+        except LangDetectException:
+            return DEFAULT_LANGUAGE
+
+    def _translate(self, text: str, language: str):
+        """
+        Traduce con timeout. Devuelve (texto, traducido_ok).
+        """
+        with self._lock:
+            if self._in_flight >= self.max_workers:
+                saturated = True
+            else:
+                saturated = False
+                self._in_flight += 1
+        if saturated:
+            print("Traducciones anteriores aún en curso. Se usa la pregunta original.")
+            metrics.inc("rag_translation_fallbacks_total", reason="saturated")
+            return text, False
+
+        future = self._executor.submit(self.backend.translate, text, language, TARGET_LANGUAGE)
+        future.add_done_callback(self._release)
+        try:
+            return future.result(timeout=self.timeout), True
+        except FutureTimeoutError:
+            print(f"La traducción ha superado {self.timeout}s. Se usa la pregunta original.")
+            metrics.inc("rag_translation_fallbacks_total", reason="timeout")
+        except Exception as e:
+            print(f"Error en la traducción ({e}). Se usa la pregunta original.")
+            metrics.inc("rag_translation_fallbacks_total", reason="error")
+        return text, False
+
+    def _release(self, future) -> None:
+        with self._lock:
+            self._in_flight -= 1
+
+    def __call__(self, question: str):
+        """
+        Detecta el idioma de la pregunta y la traduce al inglés si es necesario.
+
+        Returns:
+            tuple: (idioma detectado, pregunta en inglés)
+        """
+        key = normalize_question(question)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                metrics.inc("rag_cache_requests_total", cache="translation", result="hit")
+                return cached
+
+        metrics.inc("rag_cache_requests_total", cache="translation", result="miss")
+        with metrics.span("language_detection"):
+            language = self.detect_language(question)
+        english, ok = question, True
+        if language in TRANSLATE_LANGUAGES:
+            with metrics.span("translation"):
+                english, ok = self._translate(question, language)
+
+        result = (language, english)
+        # Los fallos no se guardan, para reintentar la traducción en la siguiente pregunta
+        if ok:
+            with self._lock:
+                self._cache[key] = result
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return result
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
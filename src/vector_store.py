@@ -0,0 +1,355 @@
+import os
+import json
+import mmap
+import threading
+from typing import Protocol
+
+import numpy as np
+
+NUMPY_STORE_DIRECTORY = "vector_store"  # Junto a chroma_db
+NUMPY_STORE_DTYPE = "int8"  # "int8" (cuantizado por fila) o "float16"
+QUERY_BLOCK_ROWS = 8192  # Filas por bloque al calcular el producto con la consulta
+
+
+class VectorStore(Protocol):
+    """
+    Interfaz mínima de almacén vectorial usada por la ingesta y las consultas.
+
+    Es el subconjunto de la API de una colección de ChromaDB que usa el proyecto. Como es
+    un Protocol, una colección de ChromaDB la cumple tal cual (sin heredar de ella) y otros
+    backends (NumpyVectorStore) se pueden usar en su lugar. Los filtros where son de
+    igualdad: {"clave": valor}.
+    """
+
+    def upsert(self, ids: list, embeddings: list, documents: list, metadatas: list) -> None: ...
+
+    def delete(self, ids: list = None, where: dict = None) -> None: ...
+
+    def get(self, ids: list = None, where: dict = None, include: list = None) -> dict: ...
+
+    def query(self, query_embeddings: list, n_results: int = 10, where: dict = None,
+              include: list = None) -> dict: ...
+
+    def count(self) -> int: ...
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Almacén vectorial en proceso basado en NumPy.
+
+    Los embeddings se guardan como una matriz int8 (con una escala por fila) o float16 en
+    un archivo binario que se abre con memory-map: varios procesos que lo consultan
+    comparten las mismas páginas de la caché del sistema operativo en lugar de cargar
+    cada uno su copia. Los ids, textos y metadatos van en un archivo JSON lines aparte.
+
+    Cada proceso mantiene en memoria los ids y los metadatos (se filtra por ellos) y un
+    array con el desplazamiento de cada línea de records.jsonl; el texto de los fragmentos
+    no se copia: se lee del archivo, también con memory-map, solo para las filas devueltas.
+
+    Los archivos solo se amplían (append): cada upsert añade filas y la última fila de un
+    id es la vigente; los borrados se registran en deleted.jsonl. compact() reescribe
+    los archivos solo con las filas vivas. La búsqueda es exacta: un producto matricial
+    vectorizado contra todas las filas.
+
+    Args:
+        directory (str): Directorio del almacén.
+        dtype (str): "int8" o "float16".
+    """
+
+    def __init__(self, directory: str = NUMPY_STORE_DIRECTORY, dtype: str = NUMPY_STORE_DTYPE):
+        if dtype not in ("int8", "float16"):
+            raise ValueError(f"dtype no soportado: {dtype}")
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self._vectors_path = os.path.join(directory, f"vectors.{dtype}")
+        self._rowinfo_path = os.path.join(directory, "rowinfo.f32")  # (escala, norma²) por fila
+        self._records_path = os.path.join(directory, "records.jsonl")
+        self._deleted_path = os.path.join(directory, "deleted.jsonl")
+        self._meta_path = os.path.join(directory, "meta.json")  # dimensión y tipo de los vectores
+        self._lock = threading.RLock()
+        self._state = None
+        self._stamp = None
+        os.makedirs(directory, exist_ok=True)
+
+    # --- Carga ---
+
+    def _file_stamp(self):
+        stamps = []
+        for path in (self._records_path, self._deleted_path):
+            try:
+                stat = os.stat(path)
+                stamps.append((stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def _load(self) -> dict:
+        """
+        Carga (o recarga si otro proceso ha escrito) el estado del almacén.
+        """
+        with self._lock:
+            stamp = self._file_stamp()
+            if self._state is not None and stamp == self._stamp:
+                return self._state
+
+            ids, metadatas, offsets = [], [], [0]
+            if os.path.exists(self._records_path):
+                with open(self._records_path, "rb") as f:
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break  # Línea a medio escribir: no confirmada
+                        record = json.loads(line)
+                        ids.append(record["id"])
+                        metadatas.append(record["metadata"])
+                        offsets.append(offsets[-1] + len(line))
+            n_rows = len(ids)
+            records = None
+            if n_rows:
+                with open(self._records_path, "rb") as f:
+                    records = mmap.mmap(f.fileno(), offsets[-1], access=mmap.ACCESS_READ)
+
+            # La última fila de cada id es la vigente; los borrados anulan las filas anteriores
+            latest = {doc_id: row for row, doc_id in enumerate(ids)}
+            if os.path.exists(self._deleted_path):
+                with open(self._deleted_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if not line.endswith("\n"):
+                            break
+                        deletion = json.loads(line)
+                        row = latest.get(deletion["id"])
+                        if row is not None and row < deletion["before"]:
+                            del latest[deletion["id"]]
+            live = np.zeros(n_rows, dtype=bool)
+            live[list(latest.values())] = True
+
+            dim = 0
+            vectors = np.zeros((0, 0), dtype=self.dtype)
+            rowinfo = np.zeros((0, 2), dtype=np.float32)
+            if n_rows:
+                with open(self._meta_path, "r", encoding="utf-8") as f:
+                    dim = json.load(f)["dim"]
+                rowinfo = np.memmap(self._rowinfo_path, dtype=np.float32, mode="r", shape=(n_rows, 2))
+                vectors = np.memmap(self._vectors_path, dtype=self.dtype, mode="r", shape=(n_rows, dim))
+
+            self._state = {
+                "ids": ids, "metadatas": metadatas, "latest": latest, "live": live,
+                "records": records, "offsets": np.asarray(offsets, dtype=np.int64), "vectors": vectors, "rowinfo": rowinfo, "dim": dim, "fields": {},
+            }
+            self._stamp = stamp
+            return self._state
+
+    def _document(self, state: dict, row: int) -> str:
+        start, end = state["offsets"][row], state["offsets"][row + 1]
+        return json.loads(state["records"][start:end])["document"]
+
+    def _field(self, state: dict, key: str) -> np.ndarray:
+        # Columna de metadatos como array para filtrar con operaciones vectorizadas
+        if key not in state["fields"]:
+            state["fields"][key] = np.asarray([meta.get(key) for meta in state["metadatas"]], dtype=object)
+        return state["fields"][key]
+
+    def _mask(self, state: dict, where: dict = None) -> np.ndarray:
+        mask = state["live"].copy()
+        for key, value in (where or {}).items():
+            mask &= self._field(state, key) == value
+        return mask
+
+    # --- Cuantización ---
+
+    def _quantize(self, embeddings: np.ndarray):
+        sqnorms = np.einsum("ij,ij->i", embeddings, embeddings)
+        if self.dtype == np.int8:
+            scales = np.abs(embeddings).max(axis=1) / 127
+            scales[scales == 0] = 1
+            quantized = np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8)
+        else:
+            scales = np.ones(len(embeddings), dtype=np.float32)
+            quantized = embeddings.astype(np.float16)
+        return quantized, np.stack([scales, sqnorms], axis=1).astype(np.float32)
+
+    def _dequantize(self, state: dict, rows) -> list:
+        vectors = np.asarray(state["vectors"][rows], dtype=np.float32)
+        return (vectors * state["rowinfo"][rows, 0][:, None]).tolist()
+
+    # --- Escritura ---
+
+    def upsert(self, ids: list, embeddings: list, documents: list, metadatas: list) -> None:
+        if not ids:
+            return
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        quantized, rowinfo = self._quantize(matrix)
+        dim = int(quantized.shape[1])
+        with self._lock:
+            state = self._load()
+            n_rows = len(state["ids"])
+            stored_dim = self._stored_dim()
+            if stored_dim is not None and stored_dim != dim:
+                # Otro modelo de embeddings: las filas existentes tienen otra anchura
+                if state["latest"]:
+                    raise ValueError(
+                        f"El almacén {self.directory} tiene vectores de dimensión {stored_dim} y se "
+                        f"intentan añadir de dimensión {dim}. Borra sus fragmentos antes de cambiar de modelo."
+                    )
+                self._reset()
+                n_rows, stored_dim = 0, None
+            if stored_dim is None:
+                with open(self._meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"dim": dim, "dtype": self.dtype.name}, f)
+            # Descartar filas de vectores de una escritura anterior que no llegó a confirmarse
+            for path, row_bytes in ((self._vectors_path, dim * self.dtype.itemsize),
+                                    (self._rowinfo_path, 2 * 4)):
+                with open(path, "ab") as f:
+                    f.truncate(n_rows * row_bytes)
+            with open(self._vectors_path, "ab") as f:
+                f.write(quantized.tobytes())
+            with open(self._rowinfo_path, "ab") as f:
+                f.write(rowinfo.tobytes())
+            # Las líneas de records.jsonl confirman las filas
+            with open(self._records_path, "a", encoding="utf-8") as f:
+                f.write("".join(
+                    json.dumps({"id": doc_id, "document": doc, "metadata": meta}) + "\n"
+                    for doc_id, doc, meta in zip(ids, documents, metadatas)
+                ))
+            self._state = None
+
+    def _stored_dim(self):
+        try:
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                return json.load(f)["dim"]
+        except FileNotFoundError:
+            return None
+
+    def _reset(self) -> None:
+        # Solo con el almacén sin filas vivas: se empieza de cero con la nueva dimensión
+        self._state = None
+        for path in (self._records_path, self._deleted_path, self._vectors_path, self._rowinfo_path,
+                     self._meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def add(self, ids: list, embeddings: list, documents: list, metadatas: list) -> None:
+        self.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def delete(self, ids: list = None, where: dict = None) -> None:
+        with self._lock:
+            state = self._load()
+            if where is not None:
+                mask = self._mask(state, where)
+                targets = [state["ids"][row] for row in np.flatnonzero(mask)]
+            else:
+                targets = ids or []
+            targets = [doc_id for doc_id in targets if doc_id in state["latest"]]
+            if not targets:
+                return
+            before = len(state["ids"])
+            with open(self._deleted_path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps({"id": doc_id, "before": before}) + "\n" for doc_id in targets))
+            self._state = None
+
+    def compact(self) -> None:
+        """
+        Reescribe los archivos solo con las filas vivas y elimina el registro de borrados.
+        """
+        with self._lock:
+            state = self._load()
+            rows = sorted(state["latest"].values())
+            if len(rows) == len(state["ids"]) and not os.path.exists(self._deleted_path):
+                return
+            vectors = np.asarray(state["vectors"][rows]) if rows else np.zeros((0, 0), dtype=self.dtype)
+            rowinfo = np.asarray(state["rowinfo"][rows]) if rows else np.zeros((0, 2), dtype=np.float32)
+            records = "".join(
+                json.dumps({"id": state["ids"][r], "document": self._document(state, r),
+                            "metadata": state["metadatas"][r]}) + "\n"
+                for r in rows
+            )
+            for path, data in ((self._vectors_path, vectors.tobytes()), (self._rowinfo_path, rowinfo.tobytes()),
+                               (self._records_path, records.encode("utf-8"))):
+                with open(path + ".tmp", "wb") as f:
+                    f.write(data)
+            # records.jsonl se sustituye el último: es el que confirma las filas
+            os.replace(self._vectors_path + ".tmp", self._vectors_path)
+            os.replace(self._rowinfo_path + ".tmp", self._rowinfo_path)
+            os.replace(self._records_path + ".tmp", self._records_path)
+            if os.path.exists(self._deleted_path):
+                os.remove(self._deleted_path)
+            self._state = None
+
+    # --- Lectura ---
+
+    def _rows_result(self, state: dict, rows, include: list) -> dict:
+        include = include if include is not None else ["documents", "metadatas"]
+        result = {"ids": [state["ids"][r] for r in rows]}
+        if "documents" in include:
+            result["documents"] = [self._document(state, r) for r in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [state["metadatas"][r] for r in rows]
+        if "embeddings" in include:
+            result["embeddings"] = self._dequantize(state, list(rows)) if len(rows) else []
+        return result
+
+    def get(self, ids: list = None, where: dict = None, include: list = None) -> dict:
+        state = self._load()
+        if ids is not None:
+            rows = [state["latest"][doc_id] for doc_id in ids if doc_id in state["latest"]]
+        else:
+            rows = list(np.flatnonzero(self._mask(state, where)))
+        return self._rows_result(state, rows, include)
+
+    def count(self) -> int:
+        return len(self._load()["latest"])
+
+    def query(self, query_embeddings: list, n_results: int = 10, where: dict = None, include: list = None) -> dict:
+        """
+        Búsqueda exacta de los n_results vecinos más cercanos (distancia L2², como ChromaDB).
+        """
+        include = include if include is not None else ["documents", "metadatas", "distances"]
+        state = self._load()
+        mask = self._mask(state, where)
+        candidates = np.flatnonzero(mask)
+        result = {"ids": []}
+        for key in include:
+            result[key] = []
+
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if len(candidates):
+            # Producto por bloques para no materializar la matriz completa en float32; cada
+            # bloque se lee una sola vez para todas las consultas del lote
+            all_dots = np.empty((len(queries), len(state["ids"])), dtype=np.float32)
+            for start in range(0, len(state["ids"]), QUERY_BLOCK_ROWS):
+                block = np.asarray(state["vectors"][start:start + QUERY_BLOCK_ROWS], dtype=np.float32)
+                scale = state["rowinfo"][start:start + len(block), 0]
+                all_dots[:, start:start + len(block)] = (queries @ block.T) * scale
+        for query_index, query in enumerate(queries):
+            if not len(candidates):
+                top = np.zeros(0, dtype=np.int64)
+                distances = np.zeros(0, dtype=np.float32)
+            else:
+                all_distances = state["rowinfo"][:, 1] + float(query @ query) - 2 * all_dots[query_index]
+                candidate_distances = all_distances[candidates]
+                k = min(n_results, len(candidates))
+                best = np.argpartition(candidate_distances, k - 1)[:k]
+                best = best[np.argsort(candidate_distances[best])]
+                top = candidates[best]
+                distances = candidate_distances[best]
+
+            rows_result = self._rows_result(state, list(top), include)
+            result["ids"].append(rows_result["ids"])
+            for key in include:
+                if key == "distances":
+                    result["distances"].append(distances.tolist())
+                else:
+                    result[key].append(rows_result[key])
+        return result
+
+
+def create_vector_store(backend: str, client=None, collection_name: str = None,
+                        directory: str = NUMPY_STORE_DIRECTORY, dtype: str = NUMPY_STORE_DTYPE) -> VectorStore:
+    """
+    Crea el almacén vectorial según el backend: "chroma" (colección de ChromaDB del
+    cliente indicado) o "numpy" (NumpyVectorStore).
+    """
+    if backend == "chroma":
+        return client.get_or_create_collection(name=collection_name)
+    if backend == "numpy":
+        return NumpyVectorStore(directory, dtype=dtype)
+    raise ValueError(f"Backend de almacén vectorial desconocido: {backend}")
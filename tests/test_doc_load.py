@@ -0,0 +1,136 @@
+"""
+Tests de src/doc_load.py contra un servidor HTTP local (sin red):
+
+    python -m pytest tests
+
+Cubren los casos 200 (descarga), 304 (sin cambios), 206 (reanudación de un .part con
+If-Range), 404 (error) y servidor sin ETag ni Last-Modified (no se vuelve a descargar).
+Las comprobaciones lanzan AssertionError explícitamente para que sigan activas con python -O.
+"""
+import os
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.doc_load import descargar_documentos, META_FILENAME
+
+# Ruta -> (contenido, ETag); None = el servidor no envía validadores
+FILES = {
+    "/con_etag.pdf": (b"%PDF-1.4 " + bytes(range(256)) * 400, '"v1"'),
+    "/sin_validadores.pdf": (b"%PDF-1.4 " + b"x" * 50000, None),
+}
+
+
+def check(condition: bool, message) -> None:
+    if not condition:
+        raise AssertionError(message)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.log.append((self.path, dict(self.headers)))
+        entry = FILES.get(self.path)
+        if entry is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body, etag = entry
+        if etag and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        status, payload = 200, body
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if range_header and (if_range is None or if_range == etag):
+            start = int(range_header.split("=")[1].rstrip("-"))
+            status, payload = 206, body[start:]
+        self.send_response(status)
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.log = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def setup(server, tmp_path):
+    """
+    Directorio de descarga vacío y urls.txt con los dos PDFs y una URL inexistente.
+    """
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    urls = {name: f"{base}/{name}" for name in ("con_etag.pdf", "sin_validadores.pdf", "no_existe.pdf")}
+    urls_file = tmp_path / "urls.txt"
+    urls_file.write_text("\n".join(urls.values()))
+    download_dir = tmp_path / "docs"
+
+    def run() -> dict:
+        server.log.clear()
+        return descargar_documentos(urls_file=str(urls_file), download_dir=str(download_dir), max_workers=2)
+
+    return urls, download_dir, run
+
+
+def _requested(server) -> dict:
+    return {path: headers for path, headers in server.log}
+
+
+def test_download_and_missing(setup):
+    urls, download_dir, run = setup
+    result = run()
+    check(result[urls["con_etag.pdf"]] == "descargado", result)
+    check(result[urls["sin_validadores.pdf"]] == "descargado", result)
+    check(result[urls["no_existe.pdf"]] == "error", result)
+    for name in ("con_etag.pdf", "sin_validadores.pdf"):
+        check((download_dir / name).read_bytes() == FILES["/" + name][0], f"{name} no coincide")
+
+
+def test_not_modified_and_no_validators(server, setup):
+    urls, _, run = setup
+    run()
+    result = run()
+    check(result[urls["con_etag.pdf"]] == "sin cambios", result)
+    check(result[urls["sin_validadores.pdf"]] == "sin cambios", result)
+    requested = _requested(server)
+    check(requested["/con_etag.pdf"].get("If-None-Match") == '"v1"', requested)
+    # Sin validadores no hay petición condicional posible: el archivo existente se conserva
+    check("/sin_validadores.pdf" not in requested, requested)
+
+
+def test_resume_partial_download(server, setup):
+    urls, download_dir, run = setup
+    run()
+    # .part de un intento interrumpido, reanudado con Range + If-Range
+    body = FILES["/con_etag.pdf"][0]
+    (download_dir / "con_etag.pdf").unlink()
+    (download_dir / "con_etag.pdf.part").write_bytes(body[:10000])
+    meta_path = download_dir / META_FILENAME
+    meta = json.loads(meta_path.read_text(encoding="utf-8"))
+    meta[urls["con_etag.pdf"]] = {"partial_etag": '"v1"'}
+    meta_path.write_text(json.dumps(meta), encoding="utf-8")
+
+    result = run()
+    check(result[urls["con_etag.pdf"]] == "reanudado", result)
+    requested = _requested(server)
+    check(requested["/con_etag.pdf"].get("Range") == "bytes=10000-", requested)
+    check((download_dir / "con_etag.pdf").read_bytes() == body, "el archivo reanudado no coincide")
+    check(not os.path.exists(download_dir / "con_etag.pdf.part"), "el .part no se ha borrado")